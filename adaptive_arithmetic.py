@@ -0,0 +1,70 @@
+from fenwick import FenwickTree
+from arithmetic import encode_rescale, decode_rescale, narrow, finish, target
+from bitstream import BitWriter, BitReader
+from instrumentation import progress_ranges
+
+# Every byte starts with a count of 1 and gains INCREMENT each time it is seen.
+# Once the total reaches MAX_TOTAL all counts are halved, which keeps the
+# interval arithmetic exact in 32 bits and lets the model track local statistics.
+ALPHABET_SIZE = 256
+INCREMENT = 32
+MAX_TOTAL = 1 << 16
+
+
+def _rescale_counts(tree):
+    return FenwickTree([(c + 1) // 2 for c in tree.counts()])
+
+
+def encode(input_message: bytes, reporter=None):
+    """Encodes input_message in a single pass, adapting the symbol counts as it
+    goes so that no model has to be stored alongside the output"""
+    precision = 32
+    one = int(2**precision - 1)
+
+    tree = FenwickTree([1] * ALPHABET_SIZE)
+    compressed_message, lo, hi, straddle = BitWriter(), 0, one, 0
+
+    for start, end in progress_ranges(len(input_message), reporter, 'Adaptive arithmetic encoded'):
+        for a in input_message[start:end]:
+            lo, hi = narrow(lo, hi, tree.cumulative(a), tree.count(a), tree.total)
+            lo, hi, compressed_message, straddle = encode_rescale(lo, hi, compressed_message, one, straddle)
+
+            tree.add(a, INCREMENT)
+            if tree.total >= MAX_TOTAL:
+                tree = _rescale_counts(tree)
+
+    if reporter is not None:
+        reporter.count('renormalisations', len(compressed_message) + straddle)
+
+    return finish(compressed_message, lo, straddle, one)
+
+
+def decode(encoded_message: bytes, num_chars: int, reporter=None):
+    precision = 32
+    one = int(2**precision - 1)
+
+    if not isinstance(encoded_message, BitReader):
+        encoded_message = BitReader(encoded_message)
+    tree = FenwickTree([1] * ALPHABET_SIZE)
+    input_message = bytearray(num_chars)
+
+    value = encoded_message.read_bits(precision)
+    lo, hi = 0, one
+
+    for start, end in progress_ranges(num_chars, reporter, 'Adaptive arithmetic decoded'):
+        for k in range(start, end):
+            # the decoder's symbol search is a descent of the Fenwick tree, O(log alphabet)
+            a, cum = tree.find(target(lo, hi, value, tree.total))
+            input_message[k] = a
+
+            lo, hi = narrow(lo, hi, cum, tree.count(a), tree.total)
+            lo, hi, value = decode_rescale(lo, hi, encoded_message, one, value)
+
+            tree.add(a, INCREMENT)
+            if tree.total >= MAX_TOTAL:
+                tree = _rescale_counts(tree)
+
+    if reporter is not None:
+        reporter.count('renormalisations', encoded_message.position - precision)
+
+    return bytes(input_message)
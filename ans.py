@@ -0,0 +1,120 @@
+"""
+Range asymmetric numeral systems (rANS) coder.
+
+The symbol counts are quantised so that they add up to 2**SCALE_BITS, and the
+coder state is an integer kept in [LOWER, LOWER << 8) by moving whole bytes in
+and out of it, rather than the single bits of arithmetic.encode_rescale.
+Encoding runs backwards over the message, so the decoder can run forwards:
+the encoded form is the final state (4 bytes, big-endian) followed by the
+renormalisation bytes in the order the decoder reads them. Decoding a symbol is
+one lookup in a table indexed by the low SCALE_BITS bits of the state.
+"""
+from instrumentation import progress_ranges
+
+SCALE_BITS = 15
+LOWER = 1 << 23  # lower bound of the normalised state interval
+
+
+def quantise_frequencies(frequencies, scale_bits=SCALE_BITS):
+    """Scales counts {symbol: count} to integers adding up to exactly
+    2**scale_bits, keeping every symbol with a non-zero count"""
+    frequencies = dict([(a, frequencies[a]) for a in sorted(frequencies) if frequencies[a] > 0])
+    scale = 1 << scale_bits
+    if len(frequencies) > scale:
+        raise NameError('Too many symbols for %d bit frequencies' % scale_bits)
+    total = sum(frequencies.values())
+    quantised = dict([(a, max(1, frequencies[a] * scale // total)) for a in frequencies])
+
+    # hand out (or take back) what the rounding left over, starting with the most
+    # frequent symbols where it costs the least
+    error = scale - sum(quantised.values())
+    by_count = sorted(quantised, key=lambda a: -frequencies[a])
+    while error != 0:
+        for a in by_count:
+            if error > 0:
+                quantised[a] += 1
+                error -= 1
+            elif quantised[a] > 1:
+                quantised[a] -= 1
+                error += 1
+            if error == 0:
+                break
+    return quantised
+
+
+def cumulative_frequencies(frequencies, total=1 << SCALE_BITS):
+    """Returns the cumulative count of every symbol of the quantised frequencies,
+    in symbol order, checking that they add up to total"""
+    cum, cumulative = 0, {}
+    for a in sorted(frequencies):
+        cumulative[a] = cum
+        cum += frequencies[a]
+    if cum != total:
+        raise NameError('Frequencies must add up to %d' % total)
+    return cumulative
+
+
+def make_decode_table(frequencies):
+    """Returns, for every value of the low SCALE_BITS bits of the state, the
+    symbol they decode to, its frequency and the offset of the slot within the
+    symbol's range"""
+    table = []
+    for a in cumulative_frequencies(frequencies):  # in symbol order, as the cumulative counts
+        table += [(a, frequencies[a], k) for k in range(frequencies[a])]
+    return table
+
+
+def encode(x, frequencies, reporter=None):
+    """Encodes the byte string x with the quantised frequencies (see quantise_frequencies)"""
+    cumulative = cumulative_frequencies(frequencies)
+    freq, cum, x_max = [0] * 256, [0] * 256, [0] * 256
+    for a in frequencies:
+        freq[a], cum[a] = frequencies[a], cumulative[a]
+        # the state must be below this before coding a, so that it stays under LOWER << 8
+        x_max[a] = ((LOWER >> SCALE_BITS) << 8) * frequencies[a]
+
+    out = bytearray()
+    state = LOWER
+    n = len(x)
+    for start, end in progress_ranges(n, reporter, 'ANS encoded'):
+        for a in reversed(x[n - end:n - start]):
+            f = freq[a]
+            m = x_max[a]
+            while state >= m:
+                out.append(state & 0xff)
+                state >>= 8
+            state = ((state // f) << SCALE_BITS) + state % f + cum[a]
+
+    if reporter is not None:
+        reporter.count('renormalisations', len(out))
+
+    out += state.to_bytes(4, 'little')
+    out.reverse()
+    return bytes(out)
+
+
+def decode(y, frequencies, num_chars, reporter=None):
+    """Inverse of encode, returning num_chars bytes"""
+    table = make_decode_table(frequencies)
+    mask = (1 << SCALE_BITS) - 1
+    lower = LOWER
+
+    state = int.from_bytes(y[:4], 'big')
+    position = 4
+    length = len(y)
+    output = bytearray(num_chars)
+    for start, end in progress_ranges(num_chars, reporter, 'ANS decoded'):
+        for k in range(start, end):
+            a, f, offset = table[state & mask]
+            output[k] = a
+            state = f * (state >> SCALE_BITS) + offset
+            while state < lower:
+                if position >= length:
+                    raise NameError('Unable to decompress')
+                state = (state << 8) | y[position]
+                position += 1
+
+    if reporter is not None:
+        reporter.count('renormalisations', position - 4)
+
+    return bytes(output)
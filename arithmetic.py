@@ -1,7 +1,13 @@
-from math import floor, ceil
-from sys import stdout as so
+from math import ceil
 from bisect import bisect
+from itertools import accumulate
 from typing import Dict
+from bitstream import BitWriter, BitReader
+from instrumentation import progress_ranges
+
+# Upper bound on the total of the integer counts the static coder works with,
+# which keeps every symbol interval non-empty at 32 bit precision
+MAX_TOTAL = 1 << 24
 
 def make_cumulative_dict(char_probs: Dict[str, float]):
     char_probs = dict([(a, char_probs[a]) for a in char_probs if char_probs[a] > 0])  # eliminate zero probabilities
@@ -17,6 +23,25 @@ def make_cumulative_dict(char_probs: Dict[str, float]):
     return dict([(a, mf) for a, mf in zip(char_probs, cum_prob)])
 
 
+def frequencies2bytes(frequencies: Dict[int, int]):
+    """Packs a count table for byte symbols as a 2 byte symbol count followed
+    by one (symbol, 4 byte count) entry per symbol"""
+    y = bytearray(len(frequencies).to_bytes(2, 'big'))
+    for a in sorted(frequencies):
+        y.append(a)
+        y += frequencies[a].to_bytes(4, 'big')
+    return bytes(y)
+
+
+def bytes2frequencies(y: bytes, offset: int = 0):
+    """Inverse of frequencies2bytes, returns the count table and the offset just past it"""
+    n = int.from_bytes(y[offset:offset + 2], 'big')
+    offset += 2
+    frequencies = dict([(y[offset + 5 * k], int.from_bytes(y[offset + 5 * k + 1:offset + 5 * k + 5], 'big'))
+                        for k in range(n)])
+    return frequencies, offset + 5 * n
+
+
 def encode_rescale(lo, hi, compressed_message, one, straddle):
     """Now we need to re-scale the interval if its end-points have bits in common,
     and output the corresponding bits where appropriate. We will do this with an
@@ -30,8 +55,8 @@ def encode_rescale(lo, hi, compressed_message, one, straddle):
             # stretch the interval by 2 and output a 0 followed by 'straddle' ones (if any)
             # and zero the straddle after that. In fact, HOLD OFF on doing the stretching:
             # we will do the stretching at the end of the if statement
-            compressed_message.append(0)  # append a zero to the output list y
-            compressed_message += [1 for s in range(straddle)]  # extend by a sequence of 'straddle' ones
+            compressed_message.write_bit(0)  # append a zero to the output y
+            compressed_message.write_run(1, straddle)  # extend by a sequence of 'straddle' ones
             straddle = 0  # zero the straddle counter
 
         elif lo >= half:  # if hi > lo >= 1/2
@@ -41,8 +66,8 @@ def encode_rescale(lo, hi, compressed_message, one, straddle):
             # to 2*(interval - 1/2), so for now just substract 1/2 from the interval upper and lower
             # bound (and don't forget that when we say "1/2" we mean the integer "half" we defined
             # above: this is an integer arithmetic implementation!
-            compressed_message.append(1)  # append a 1 to the output list y
-            compressed_message += [0 for s in range(straddle)]  # extend 'straddle' zeros
+            compressed_message.write_bit(1)  # append a 1 to the output y
+            compressed_message.write_run(0, straddle)  # extend 'straddle' zeros
             straddle = 0  # reset the straddle counter
             lo -= half
             hi -= half  # subtract half from lo and hi
@@ -63,49 +88,72 @@ def encode_rescale(lo, hi, compressed_message, one, straddle):
         hi = hi * 2 + 1  # adding 1 seems to solve a minor precision problem
 
 
-def encode(input_message: str, char_probs: Dict[str, float]):
-    """"Encodes input_message using probabilities char_probs"""
-    precision = 32
-    one = int(2**precision - 1)
-    quarter = int(ceil(one/4))
+def narrow(lo, hi, cum, freq, total):
+    """Narrows [lo, hi] to the sub-interval [cum, cum + freq) out of total, using
+    integer counts only"""
+    lohi_range = hi - lo + 1
+    return lo + lohi_range * cum // total, lo + lohi_range * (cum + freq) // total - 1
 
-    cum_prob_dict = make_cumulative_dict(char_probs)
-    
-    compressed_message, lo, hi, straddle = [], 0, one, 0
 
-    for k, a in enumerate(input_message): # for every symbol
+def finish(compressed_message, lo, straddle, one):
+    """Flushes the bits needed to identify the final interval"""
+    quarter = int(ceil(one / 4))
+    straddle += 1  # add 1 to straddle for "good measure" (ensures prefix-freeness)
+    if lo < quarter:  # the position of lo determines the dyadic interval that fits
+        compressed_message.write_bit(0)
+        compressed_message.write_run(1, straddle)
+    else:
+        compressed_message.write_bit(1)
+        compressed_message.write_run(0, straddle)
+    return compressed_message.getvalue()
 
-        # arithmetic coding is slower than vl_encode, so we display a "progress bar"
-        # to let the user know that we are processing the file and haven't crashed...
-        if k % 100 == 0:
-            so.write('Arithmetic encoded %d%%    \r' % int(floor(k / len(input_message) * 100)))
-            so.flush()
 
-        lohi_range = hi - lo + 1  # The added 1 is necessary to avoid rounding issues
+def target(lo, hi, value, total):
+    """Inverse of narrow: the count in [0, total) whose sub-interval contains value"""
+    return ((value - lo + 1) * total - 1) // (hi - lo + 1)
 
-        # 2) narrow the interval end-points [lo,hi) to the new range [f,f+p]
-        # within the old interval [lo,hi], being careful to round 'innwards'
-        lo += ceil(cum_prob_dict[a] * lohi_range)
-        hi = lo + floor(char_probs[a] * lohi_range)
 
-        if lo == hi:
-            raise NameError('Zero interval!')
+def quantise(char_probs: Dict[str, float]):
+    """Turns probabilities (or any non-negative weights, such as counts) into
+    integer counts, in symbol order, whose total is at most MAX_TOTAL so that
+    every symbol keeps a non-empty interval. Integer counts that already fit
+    are kept as they are."""
+    weights = dict([(a, char_probs[a]) for a in sorted(char_probs) if char_probs[a] > 0])
+    total = sum(weights.values())
+    if all([isinstance(w, int) for w in weights.values()]) and total <= MAX_TOTAL:
+        return weights
+    return dict([(a, max(1, int(weights[a] * MAX_TOTAL / total))) for a in weights])
 
-        lo, hi, compressed_message, straddle = encode_rescale(lo, hi, compressed_message, one, straddle)
 
-    # termination bits - after processing all input symbols, flush any bits still in the 'straddle' pipeline
-    straddle += 1  # add 1 to straddle for "good measure" (ensures prefix-freeness)
-    if lo < quarter:  # the position of lo determines the dyadic interval that fits
-        compressed_message.append(0)
-        compressed_message += [1 for s in range(straddle)]
-    else:
-        compressed_message.append(1)
-        compressed_message += [0 for s in range(straddle)]
+def encode(input_message: str, char_probs: Dict[str, float], reporter=None):
+    """"Encodes input_message using probabilities char_probs"""
+    precision = 32
+    one = int(2**precision - 1)
+
+    # the interval is narrowed with integer counts only, so that the decoder
+    # can follow the encoder exactly whatever the rounding
+    counts = quantise(char_probs)
+    cum_count = dict(zip(counts, accumulate([0] + list(counts.values()))))
+    total = sum(counts.values())
 
-    return compressed_message
+    compressed_message, lo, hi, straddle = BitWriter(), 0, one, 0
 
+    # arithmetic coding is slower than vl_encode, so a reporter can be given to
+    # follow the progress (it is told every PROGRESS_INTERVAL symbols)
+    for start, end in progress_ranges(len(input_message), reporter, 'Arithmetic encoded'):
+        for a in input_message[start:end]: # for every symbol
+            lo, hi = narrow(lo, hi, cum_count[a], counts[a], total)
+            lo, hi, compressed_message, straddle = encode_rescale(lo, hi, compressed_message, one, straddle)
 
-def decode_rescale(lo, hi, encoded_message, position, one, value):
+    if reporter is not None:
+        # every bit output or straddle pending stands for one doubling of the interval
+        reporter.count('renormalisations', len(compressed_message) + straddle)
+
+    # termination bits - after processing all input symbols, flush any bits still in the 'straddle' pipeline
+    return finish(compressed_message, lo, straddle, one)
+
+
+def decode_rescale(lo, hi, encoded_message, one, value):
     quarter = int(ceil(one / 4))
     half = 2 * quarter
     threequarters = 3 * quarter
@@ -122,62 +170,45 @@ def decode_rescale(lo, hi, encoded_message, position, one, value):
             hi = hi - quarter
             value = value - quarter
         else:
-            return lo, hi, position, value
+            return lo, hi, value
         lo = 2 * lo
         hi = 2 * hi + 1
-        value = 2 * value + encoded_message[position]
-        position += 1
-        if position == len(encoded_message):
+        value = 2 * value + encoded_message.read_bit()
+        # reading past the end yields the dummy zeros the encoder implicitly
+        # terminated with, but never more than 'precision' of them
+        if encoded_message.position > encoded_message.length + one.bit_length():
             raise NameError('Unable to decompress')
 
 
-def decode(encoded_message: str, char_probs: Dict[str, float], num_chars: int):
+def decode(encoded_message: bytes, char_probs: Dict[str, float], num_chars: int, reporter=None):
     precision = 32
     one = int(2**precision - 1)
 
-    char_probs = dict([(a, char_probs[a]) for a in char_probs if char_probs[a] > 0])
-    
-    alphabet = list(char_probs)
-    cum_prob = [0]
-    for a in char_probs:
-        cum_prob.append(cum_prob[-1] + char_probs[a])
-    cum_prob.pop()
-
-    char_probs = list(char_probs.values())
+    counts = quantise(char_probs)
+    alphabet = list(counts)
+    cum_count = list(accumulate([0] + list(counts.values())))
+    total = cum_count[-1]
 
-    encoded_message.extend(precision * [0]) # dummy zeros to prevent index out of bound errors
+    if not isinstance(encoded_message, BitReader):
+        encoded_message = BitReader(encoded_message)
     input_message = num_chars*[0] # initialise all zeros
 
     # initialise by taking first 'precision' bits from y and converting to a number
-    value = int(''.join(str(a) for a in encoded_message[0:precision]), 2)
-    position = precision # position where currently reading y
+    # (the reader pads with dummy zeros once the stream runs out)
+    value = encoded_message.read_bits(precision)
     lo, hi = 0, one
 
-    for k in range(num_chars):
-        if k % 100 == 0:
-            so.write('Arithmetic decoded %d%%    \r' % int(floor(k/num_chars*100)))
-            so.flush()
-        print('lo: ', lo)
-        print('hi: ', hi)
-
-        lohi_range = hi - lo + 1
-        print('lohi range: ', lohi_range)
-        # This is an essential subtelty: the slowest part of the decoder is figuring out
-        # which symbol lands us in an interval that contains the encoded binary string.
-        # This can be extremely wasteful (o(n) where n is the alphabet size) if you proceed
-        # by simple looping and comparing. Here we use Python's "bisect" function that
-        # implements a binary search and is 100 times more efficient. Try
-        # for a = [a for a in f if f[a]<(value-lo)/lohi_range)][-1] for a MUCH slower solution.
-        a = bisect(cum_prob, (value-lo)/lohi_range) - 1
-        input_message[k] = alphabet[a]
-        print('value: ', alphabet[a])
-        print()
-
-        lo = lo + int(ceil(cum_prob[a]*lohi_range))
-        hi = lo + int(floor(char_probs[a] * lohi_range))
-        if lo == hi:
-            raise NameError('Zero interval!')
-
-        lo, hi, position, value = decode_rescale(lo, hi, encoded_message, position, one, value)
+    for start, end in progress_ranges(num_chars, reporter, 'Arithmetic decoded'):
+        for k in range(start, end):
+            # finding the symbol whose interval contains value is a binary search
+            # over the cumulative counts (Python's bisect), rather than a loop
+            # over the alphabet which would be o(n) in the alphabet size
+            j = bisect(cum_count, target(lo, hi, value, total)) - 1
+            input_message[k] = alphabet[j]
+            lo, hi = narrow(lo, hi, cum_count[j], cum_count[j + 1] - cum_count[j], total)
+            lo, hi, value = decode_rescale(lo, hi, encoded_message, one, value)
+
+    if reporter is not None:
+        reporter.count('renormalisations', encoded_message.position - precision)
 
     return input_message
@@ -0,0 +1,171 @@
+"""Batch compression and decompression of many files with a pool of processes.
+
+The inputs are files, directories (every file below them) and glob patterns.
+Each file is a task for a pool of jobs worker processes, so Python starts only
+jobs times, and as the workers are reused the models they build or load
+(shared registry models, context models, code tables) are cached once per
+worker for all the files it handles (see model_registry.CACHE).
+
+Outputs are written to a temporary name and renamed once complete, so an
+interrupted run never leaves a partial output behind. The run ends by writing a
+JSON manifest with the settings of the run and the sizes and timings of every
+file, and a rerun with the same settings skips every file whose output is
+newer than it and listed in that manifest.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob, has_magic
+from time import perf_counter
+import json
+import os
+
+from container import compress_stream, decompress_stream, check_params, METHODS, BLOCK_SIZE, read_header
+from model_registry import REGISTRY_DIR
+
+MANIFEST = 'camzip_manifest.json'
+
+
+def expand(paths, compressed=None, exclude=()):
+    """Returns the files named by paths (files, directories or glob patterns),
+    sorted and without duplicates. If compressed is True only CamZIP files are
+    kept, if False they are left out. The files named in exclude (such as the
+    manifest) and the outputs of earlier runs are left out too."""
+    files = []
+    for path in paths:
+        names = glob(path, recursive=True) if has_magic(path) else [path]
+        for name in names:
+            if os.path.isdir(name):
+                for root, dirs, filenames in os.walk(name):
+                    files += [os.path.join(root, f) for f in filenames]
+            elif os.path.isfile(name):
+                files.append(name)
+            else:
+                raise NameError('No such file or directory: %s' % name)
+    # .part files are leftovers of interrupted runs, .cuz files decompressed outputs
+    exclude = set([os.path.abspath(f) for f in exclude if f is not None])
+    files = sorted(set([f for f in files if not f.endswith(('.part', '.cuz')) and os.path.abspath(f) not in exclude]))
+    if compressed is not None:
+        files = [f for f in files if is_compressed(f) == compressed]
+    return files
+
+
+def is_compressed(filename):
+    try:
+        with open(filename, 'rb') as fin:
+            read_header(fin)
+        return True
+    except NameError:
+        return False
+
+
+def compressed_name(filename, method):
+    return filename + '.cz' + METHODS[method].decode().lower()
+
+
+def decompressed_name(filename):
+    # '.cuz' for Cam UnZipped, in place of the .cz? extension as camunzip does
+    root, extension = os.path.splitext(filename)
+    return (root if extension.startswith('.cz') else filename) + '.cuz'
+
+
+def up_to_date(infile, outfile):
+    return os.path.exists(outfile) and os.path.getmtime(outfile) >= os.path.getmtime(infile)
+
+
+def _run(stream, infile, outfile, *args):
+    """Runs stream(fin, fout, *args) from infile into outfile, renaming the
+    output into place once it is complete"""
+    start = perf_counter()
+    with open(infile, 'rb') as fin, open(outfile + '.part', 'wb') as fout:
+        stream(fin, fout, *args)
+    os.replace(outfile + '.part', outfile)
+    return perf_counter() - start
+
+
+def _compress_file(infile, outfile, method, block_size, params, index):
+    return _run(compress_stream, infile, outfile, method, block_size, 1, params, None, index)
+
+
+def _decompress_file(infile, outfile, registry):
+    return _run(decompress_stream, infile, outfile, 1, None, registry)
+
+
+def _previous_outputs(manifest, settings):
+    """The outputs listed in the manifest of an earlier run with the same settings"""
+    try:
+        with open(manifest) as fin:
+            report = json.load(fin)
+    except (OSError, ValueError):
+        return set()
+    if any([report.get(key) != value for key, value in settings.items()]):
+        return set()
+    return set([os.path.abspath(e['output']) for e in report.get('files', [])])
+
+
+def _settings(params):
+    """params as they are written in the manifest"""
+    return dict([(key, value.hex() if isinstance(value, bytes) else value) for key, value in (params or {}).items()])
+
+
+def _entry(infile, outfile, seconds, skipped):
+    return {'input': infile, 'output': outfile,
+            'input_bytes': os.path.getsize(infile), 'output_bytes': os.path.getsize(outfile),
+            'seconds': seconds, 'skipped': skipped}
+
+
+def _batch(tasks, func, jobs, force, manifest, settings, log):
+    """Runs func(infile, outfile, *args) for every (infile, outfile, args) task
+    whose output is not up to date, in a pool of jobs processes. An output is
+    only up to date if the previous manifest shows it was written with the same
+    settings."""
+    previous = set() if force or manifest is None else _previous_outputs(manifest, settings)
+    entries, pending = [], []
+    for infile, outfile, args in tasks:
+        if os.path.abspath(outfile) in previous and up_to_date(infile, outfile):
+            entries.append(_entry(infile, outfile, 0.0, True))
+        else:
+            pending.append((infile, outfile, args))
+
+    start = perf_counter()
+    with ProcessPoolExecutor(max(jobs, 1)) as executor:
+        futures = [(infile, outfile, executor.submit(func, infile, outfile, *args))
+                   for infile, outfile, args in pending]
+        for infile, outfile, future in futures:
+            entries.append(_entry(infile, outfile, future.result(), False))
+            if log is not None:
+                log.write('%s -> %s\n' % (infile, outfile))
+
+    entries.sort(key=lambda e: e['input'])
+    report = dict(settings)
+    report.update({'files': entries,
+                   'processed': len(pending),
+                   'skipped': len(entries) - len(pending),
+                   'input_bytes': sum([e['input_bytes'] for e in entries]),
+                   'output_bytes': sum([e['output_bytes'] for e in entries]),
+                   'seconds': perf_counter() - start})
+    if manifest is not None:
+        with open(manifest, 'w') as fout:
+            json.dump(report, fout, indent=1)
+    return report
+
+
+def compress_files(paths, method, block_size=BLOCK_SIZE, jobs=1, params=None, force=False, manifest=MANIFEST,
+                   log=None, index=False):
+    """Compresses every file named by paths (see expand) that is not already
+    compressed next to itself, as camzip does, with jobs processes. Files whose
+    output is up to date are skipped unless force is set. Returns the manifest,
+    which is also written to the file manifest unless that is None. index adds
+    a block index to every output."""
+    check_params(method, params)
+    tasks = [(f, compressed_name(f, method), (method, block_size, params, index))
+             for f in expand(paths, compressed=False, exclude=[manifest])]
+    settings = {'operation': 'compress', 'method': method, 'block_size': block_size, 'index': index,
+                'params': _settings(params)}
+    return _batch(tasks, _compress_file, jobs, force, manifest, settings, log)
+
+
+def decompress_files(paths, jobs=1, registry=REGISTRY_DIR, force=False, manifest=MANIFEST, log=None):
+    """Decompresses every CamZIP file named by paths as camunzip does, with
+    jobs processes, skipping outputs that are up to date as compress_files does"""
+    tasks = [(f, decompressed_name(f), (registry,)) for f in expand(paths, compressed=True, exclude=[manifest])]
+    settings = {'operation': 'decompress', 'registry': registry}
+    return _batch(tasks, _decompress_file, jobs, force, manifest, settings, log)
@@ -0,0 +1,191 @@
+"""Reproducible benchmark of every CamZIP method over the text_files corpus.
+
+Every (file, method) pair is compressed and decompressed through the block
+container in a fresh process, so the peak resident memory recorded is that of
+the coder alone. For contextual arithmetic a model of each order is trained on
+the rest of the corpus, holding out the file being measured so that its
+bits/byte are not measured on training data, and its training time is
+reported as model build time. Methods
+are taken from container.METHODS, so new engines are benchmarked as soon as
+they are registered there.
+
+The report is JSON and can be compared against a baseline report:
+
+    python benchmark.py --output baseline.json
+    python benchmark.py --output report.json --baseline baseline.json
+
+which lists every result that got bigger, slower or hungrier than the
+baseline and exits with status 1 if there are any.
+"""
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from io import BytesIO
+from time import perf_counter
+import json
+import os
+import platform
+import resource
+import sys
+
+from container import METHODS, BLOCK_SIZE, compress_stream, decompress_stream
+from context_model import write_model
+from contextual_arithmetic import count_contexts
+from instrumentation import MetricsReporter
+from ppm import DEFAULT_ORDER
+
+CORPUS = ['hamlet.txt', 'romeo_and_juliet.txt', 'great_expectations.txt', 'war_and_peace.txt',
+          'encyclopedia_britannica.txt']
+CONTEXTUAL = 'contextual arithmetic'
+CONTEXTUAL_ORDERS = (1, 2, 3)
+# default allowed fractional loss of speed or memory before a result counts as
+# a regression; sizes are deterministic, so any growth of those is one
+TOLERANCE = 0.1
+
+
+def _train(order, files, held_out):
+    """Writes a model of the given order trained on files other than held_out to
+    cond_prob_models/, returning its name and the time taken"""
+    start = perf_counter()
+    training_data = b''.join([open('text_files/' + f, 'rb').read() for f in files if f != held_out])
+    name = 'benchmark%d_%s.czm' % (order, held_out)
+    os.makedirs('cond_prob_models', exist_ok=True)
+    write_model('cond_prob_models/' + name, order, count_contexts(training_data, order),
+                count_contexts(training_data, 0)[0])
+    return name, perf_counter() - start
+
+
+def _measure(filename, method, params, block_size, repeats):
+    """Runs in a fresh process: codes text_files/filename with method, keeping the
+    fastest of repeats runs, and checks that it decodes back to the original"""
+    with open('text_files/' + filename, 'rb') as fin:
+        x = fin.read()
+
+    compress_seconds, decompress_seconds = float('inf'), float('inf')
+    for k in range(repeats):
+        reporter = MetricsReporter()
+        compressed = BytesIO()
+        start = perf_counter()
+        compress_stream(BytesIO(x), compressed, method, block_size, 1, params, reporter)
+        compress_seconds = min(compress_seconds, perf_counter() - start)
+
+        decompressed = BytesIO()
+        start = perf_counter()
+        decompress_stream(BytesIO(compressed.getvalue()), decompressed, 1)
+        decompress_seconds = min(decompress_seconds, perf_counter() - start)
+        if decompressed.getvalue() != x:
+            raise NameError('%s did not decompress %s to the original' % (method, filename))
+
+    size = len(compressed.getvalue())
+    return {'original_bytes': len(x),
+            'compressed_bytes': size,
+            'bits_per_byte': 8 * size / len(x) if x else 0.0,
+            'compress_mb_s': len(x) / compress_seconds / 1e6,
+            'decompress_mb_s': len(x) / decompress_seconds / 1e6,
+            'model_seconds': reporter.stages.get('model', 0.0),
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'counts': dict(reporter.counts)}
+
+
+def _isolated(func, *args):
+    """Calls func(*args) in a newly spawned process"""
+    with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as executor:
+        return executor.submit(func, *args).result()
+
+
+def result_key(result):
+    return result['file'], result['method'], result['order']
+
+
+def run(files=CORPUS, methods=None, orders=CONTEXTUAL_ORDERS, block_size=BLOCK_SIZE, repeats=1, log=sys.stderr):
+    """Benchmarks methods (by default all of container.METHODS) on files in
+    text_files/, contextual arithmetic at every order in orders, and returns
+    the report as a dictionary"""
+    methods = methods or list(METHODS)
+    models = {}  # (order, held out file): (model name, training time)
+    results = []
+    try:
+        _run(files, methods, orders, block_size, repeats, log, models, results)
+    finally:
+        for name, seconds in models.values():
+            os.remove('cond_prob_models/' + name)
+
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'block_size': block_size,
+            'repeats': repeats,
+            'results': results}
+
+
+def _run(files, methods, orders, block_size, repeats, log, models, results):
+    for filename in files:
+        for method in methods:
+            if method == CONTEXTUAL:
+                runs = [(order, {'order': order}) for order in orders]
+            elif method == 'ppm':
+                runs = [(DEFAULT_ORDER, {'order': DEFAULT_ORDER})]
+            else:
+                runs = [(None, {})]
+
+            for order, params in runs:
+                training_seconds = 0.0
+                if method == CONTEXTUAL:
+                    if (order, filename) not in models:
+                        models[order, filename] = _train(order, list(dict.fromkeys(CORPUS + list(files))), filename)
+                    params['model'], training_seconds = models[order, filename]
+                result = _isolated(_measure, filename, method, params, block_size, repeats)
+                result.update({'file': filename, 'method': method, 'order': order})
+                result['model_seconds'] += training_seconds
+                results.append(result)
+                if log is not None:
+                    log.write('%-28s %-22s %5s %6.3f bits/byte %7.3f / %7.3f MB/s\n' %
+                              (filename, method, '' if order is None else order, result['bits_per_byte'],
+                               result['compress_mb_s'], result['decompress_mb_s']))
+
+
+def compare(report, baseline, tolerance=TOLERANCE):
+    """Returns a list of (file, method, order, metric, baseline value, value) for
+    every result of report that is worse than the same result of baseline"""
+    previous = dict([(result_key(r), r) for r in baseline['results']])
+    regressions = []
+    for result in report['results']:
+        old = previous.get(result_key(result))
+        if old is None:
+            continue
+        worse = []
+        if result['compressed_bytes'] > old['compressed_bytes']:
+            worse.append('compressed_bytes')
+        for metric in ('compress_mb_s', 'decompress_mb_s'):
+            if result[metric] < old[metric] * (1 - tolerance):
+                worse.append(metric)
+        if result['peak_rss_kb'] > old['peak_rss_kb'] * (1 + tolerance):
+            worse.append('peak_rss_kb')
+        regressions += [result_key(result) + (metric, old[metric], result[metric]) for metric in worse]
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(epilog='Example: python %s --output report.json --baseline baseline.json' % sys.argv[0])
+    parser.add_argument('--output', default='benchmark.json', help='JSON report to write')
+    parser.add_argument('--baseline', help='JSON report to compare against')
+    parser.add_argument('--files', nargs='+', default=CORPUS, help='files in text_files/ to benchmark')
+    parser.add_argument('--methods', nargs='+', help='methods to benchmark (default: all of them)')
+    parser.add_argument('--orders', nargs='+', type=int, default=CONTEXTUAL_ORDERS,
+                        help='context orders for contextual arithmetic')
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE)
+    parser.add_argument('--repeats', type=int, default=1, help='runs per measurement, the fastest is kept')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='fraction of speed or memory that may be lost before it counts as a regression')
+    args = parser.parse_args()
+
+    report = run(args.files, args.methods, args.orders, args.block_size, args.repeats)
+    with open(args.output, 'w') as fout:
+        json.dump(report, fout, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as fin:
+            regressions = compare(report, json.load(fin), args.tolerance)
+        for filename, method, order, metric, old, new in regressions:
+            print('%s %s%s: %s %s -> %s' % (filename, method, '' if order is None else ' order %d' % order,
+                                            metric, old, new))
+        sys.exit(1 if regressions else 0)
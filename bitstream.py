@@ -0,0 +1,142 @@
+"""Packed bit buffers used by all the coders.
+
+Bits are stored most significant bit first in a bytearray. The first 3 bits of
+a packed stream hold the number of padding bits added at the end to complete
+the last byte, which is the same layout that bits2bytes always produced, so
+files written through a BitWriter can be read with bytes2bits and vice versa.
+"""
+
+
+class BitWriter:
+    def __init__(self, header=True):
+        self.buffer = bytearray()
+        self.acc = 0  # bits not yet flushed to the buffer
+        self.nacc = 0  # number of bits held in acc
+        self.header = header
+        if header:
+            self.nacc = 3  # reserve room for the padding count
+
+    def __len__(self):
+        """Number of bits written (not counting the padding header)"""
+        return 8 * len(self.buffer) + self.nacc - (3 if self.header else 0)
+
+    def _flush(self):
+        nbytes = self.nacc >> 3
+        if nbytes:
+            self.nacc -= 8 * nbytes
+            self.buffer += (self.acc >> self.nacc).to_bytes(nbytes, 'big')
+            self.acc &= (1 << self.nacc) - 1
+
+    def write_bit(self, bit):
+        self.acc = (self.acc << 1) | bit
+        self.nacc += 1
+        if self.nacc >= 64:
+            self._flush()
+
+    def write_bits(self, value, n):
+        """Appends the n least significant bits of value, most significant first"""
+        self.acc = (self.acc << n) | (value & ((1 << n) - 1))
+        self.nacc += n
+        if self.nacc >= 64:
+            self._flush()
+
+    def write_run(self, bit, n):
+        """Appends n copies of bit"""
+        if n <= 0:
+            return
+        self.acc <<= n
+        if bit:
+            self.acc |= (1 << n) - 1
+        self.nacc += n
+        if self.nacc >= 64:
+            self._flush()
+
+    def write_bitstring(self, bits):
+        """Appends a string of '0' and '1' characters. Converting a long string in
+        one go is much faster than appending its bits one at a time."""
+        if bits:
+            self.acc = (self.acc << len(bits)) | int(bits, 2)
+            self.nacc += len(bits)
+            self._flush()
+
+    def extend(self, bits):
+        """Appends an iterable of 0/1 ints. Anything else (such as the bytes of a
+        stream that is already packed) is rejected rather than written."""
+        bits = list(bits)
+        if not all([bit in (0, 1) for bit in bits]):
+            raise NameError('A list of bits must hold only 0s and 1s')
+        self.write_bitstring(''.join(['1' if bit else '0' for bit in bits]))
+
+    def getvalue(self):
+        """Returns the packed stream, padded to a whole number of bytes"""
+        self._flush()
+        out = bytearray(self.buffer)
+        r = (8 - self.nacc % 8) % 8
+        if self.nacc:
+            out.append(((self.acc << r) & 0xff))
+        if self.header:
+            out[0] |= r << 5
+        return bytes(out)
+
+
+class BitReader:
+    def __init__(self, data, header=True):
+        """data is a packed stream, or a list of 0/1 ints (as bytes2bits returns),
+        which has no padding header and is read bit for bit"""
+        bits = None
+        if isinstance(data, (list, tuple)):
+            bits = len(data)
+            w = BitWriter(header=False)
+            w.extend(data)
+            data, header = w.getvalue(), False
+        elif not isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data)
+        self.data = memoryview(data)
+        self.position = 0
+        self.length = 8 * len(self.data) if bits is None else bits
+        if header:
+            if len(self.data) == 0:
+                raise NameError('Empty bit stream')
+            r = self.data[0] >> 5
+            self.position = 3
+            self.length -= r
+
+    def __len__(self):
+        """Number of payload bits left to read"""
+        return max(self.length - self.position, 0)
+
+    def read_bit(self):
+        """Reads one bit, returning 0 once the stream is exhausted"""
+        pos = self.position
+        self.position = pos + 1
+        if pos >= self.length:
+            return 0
+        return (self.data[pos >> 3] >> (7 - (pos & 7))) & 1
+
+    def peek_bits(self, n):
+        """Returns the next n bits as an integer without consuming them,
+        padding with zeros past the end of the stream"""
+        pos = self.position
+        first = pos >> 3
+        last = (pos + n + 7) >> 3
+        chunk = self.data[first:last]
+        value = int.from_bytes(chunk, 'big') << 8 * (last - first - len(chunk))  # zero fill past the end
+        value >>= 8 * (last - first) - (pos & 7) - n
+        value &= (1 << n) - 1
+        if pos + n > self.length:  # mask out padding bits
+            extra = pos + n - self.length
+            value = (value >> extra) << extra if extra < n else 0
+        return value
+
+    def read_bits(self, n):
+        """Reads n bits as an integer"""
+        value = self.peek_bits(n)
+        self.position += n
+        return value
+
+    def skip(self, n):
+        self.position += n
+
+    def __iter__(self):
+        while self.position < self.length:
+            yield self.read_bit()
@@ -0,0 +1,248 @@
+"""
+Burrows-Wheeler transform, move-to-front and zero run-length coding.
+
+transform turns a block into bytes that an order 0 coder (huffman, arithmetic)
+codes far better than the block itself: the BWT sorts the characters by the
+text that follows them, so characters in similar contexts end up next to each
+other, move-to-front turns those runs of similar characters into runs of small
+numbers, mostly zeros, and the zero runs are then written in a few symbols.
+
+The suffix array behind the BWT is built by induced sorting (SA-IS), in time
+linear in the block length, and the inverse transform is linear too.
+
+Zero runs are written as bzip2 does, as their length in bijective base 2 with
+the digits RUNA (0) and RUNB (1); every other move-to-front value v is written
+as v + 1, except 254 and 255, which do not fit in a byte that way and are
+written as ESCAPE followed by v - 254. So the output is still a byte string.
+"""
+
+RUNA, RUNB = 0, 1
+ESCAPE = 255
+
+
+def _buckets(counts, end):
+    """Start (or with end set, one past the end) of every symbol's bucket"""
+    buckets, total = [0] * len(counts), 0
+    for c, count in enumerate(counts):
+        total += count
+        buckets[c] = total if end else total - count
+    return buckets
+
+
+def _induce(s, stype, sa, counts):
+    """Sorts the L type suffixes then the S type ones from the LMS suffixes
+    already in place at the ends of their buckets"""
+    # the scans see the entries written ahead of them, as list iterators read sa live
+    heads = _buckets(counts, False)
+    for i in sa:
+        if i > 0 and not stype[i - 1]:
+            c = s[i - 1]
+            sa[heads[c]] = i - 1
+            heads[c] += 1
+    tails = _buckets(counts, True)
+    for i in reversed(sa):
+        if i > 0 and stype[i - 1]:
+            c = s[i - 1]
+            tails[c] -= 1
+            sa[tails[c]] = i - 1
+
+
+def suffix_array(s, alphabet_size):
+    """
+    Returns the suffix array of s, a list of integers in range(alphabet_size)
+    ending with a 0 that occurs nowhere else, by induced sorting (SA-IS).
+    """
+    n = len(s)
+    if n == 1:
+        return [0]
+
+    # a suffix is S type if it is smaller than the next one, L type otherwise
+    stype = [False] * n
+    stype[n - 1] = True
+    for i in range(n - 2, -1, -1):
+        stype[i] = s[i] < s[i + 1] or (s[i] == s[i + 1] and stype[i + 1])
+    lms = [i for i in range(1, n) if stype[i] and not stype[i - 1]]
+    counts = [0] * alphabet_size
+    for c in s:
+        counts[c] += 1
+
+    # sort the LMS substrings by placing the LMS suffixes in their buckets and inducing
+    sa = [-1] * n
+    tails = _buckets(counts, True)
+    for i in reversed(lms):
+        tails[s[i]] -= 1
+        sa[tails[s[i]]] = i
+    _induce(s, stype, sa, counts)
+
+    # name the LMS substrings in sorted order, equal substrings sharing a name
+    is_lms = [False] * n
+    for i in lms:
+        is_lms[i] = True
+    names = [-1] * n
+    name, previous = -1, -1
+    for i in sa:
+        if not is_lms[i]:
+            continue
+        if previous == -1 or not _same_lms_substring(s, stype, is_lms, previous, i):
+            name += 1
+        names[i] = name
+        previous = i
+    reduced = [names[i] for i in lms]
+
+    # sort the LMS suffixes, recursing when two LMS substrings are equal
+    if name + 1 < len(reduced):
+        order = suffix_array(reduced, name + 1)
+    else:
+        order = [0] * len(reduced)
+        for k, r in enumerate(reduced):
+            order[r] = k
+
+    # induce the whole suffix array from the sorted LMS suffixes
+    sa = [-1] * n
+    tails = _buckets(counts, True)
+    for k in reversed(order):
+        i = lms[k]
+        tails[s[i]] -= 1
+        sa[tails[s[i]]] = i
+    _induce(s, stype, sa, counts)
+    return sa
+
+
+def _same_lms_substring(s, stype, is_lms, i, j):
+    n = len(s)
+    k = 0
+    while True:
+        if i + k == n or j + k == n or s[i + k] != s[j + k] or stype[i + k] != stype[j + k]:
+            return False
+        k += 1
+        if is_lms[i + k] or is_lms[j + k]:
+            return is_lms[i + k] and is_lms[j + k] and s[i + k] == s[j + k]
+
+
+def bwt(x):
+    """
+    Returns the Burrows-Wheeler transform of the bytes x, with an end of text
+    marker smaller than any byte: the last column of the sorted rotations of x
+    and the marker, without the marker, and the row it was in.
+    """
+    s = [a + 1 for a in x]
+    s.append(0)  # the end of text marker
+    sa = suffix_array(s, 257)
+    primary = sa.index(0)
+    y = bytes([x[i - 1] for i in sa if i > 0])
+    return y, primary
+
+
+def inverse_bwt(y, primary):
+    """Inverse of bwt, in time linear in the length of y"""
+    n = len(y)
+    # row of the first column holding the first occurrence of each byte, the
+    # end of text marker taking row 0
+    counts = [0] * 256
+    for a in y:
+        counts[a] += 1
+    first, total = [0] * 256, 1
+    for a in range(256):
+        first[a] = total
+        total += counts[a]
+
+    # the row each row's last character starts in the first column (LF mapping),
+    # the marker being at row primary of the last column
+    lf = [0] * (n + 1)
+    for i, a in enumerate(y):
+        row = i + 1 if i >= primary else i
+        lf[row] = first[a]
+        first[a] += 1
+
+    x = bytearray(n)
+    row = 0  # the rotation starting with the marker ends with the last byte of x
+    for k in range(n - 1, -1, -1):
+        x[k] = y[row - 1 if row > primary else row]
+        row = lf[row]
+    return bytes(x)
+
+
+def mtf_encode(x):
+    """Replaces every byte by its position in a list of the bytes, most recently
+    used first"""
+    order = list(range(256))
+    y = bytearray(len(x))
+    for k, a in enumerate(x):
+        i = order.index(a)
+        y[k] = i
+        if i:
+            del order[i]
+            order.insert(0, a)
+    return bytes(y)
+
+
+def mtf_decode(y):
+    order = list(range(256))
+    x = bytearray(len(y))
+    for k, i in enumerate(y):
+        a = order[i]
+        x[k] = a
+        if i:
+            del order[i]
+            order.insert(0, a)
+    return bytes(x)
+
+
+def rle0_encode(x):
+    """Writes the runs of zeros of x in bijective base 2 with RUNA and RUNB and
+    shifts the other values up by one (see the module docstring)"""
+    y = bytearray()
+    run = 0
+    for a in x:
+        if a == 0:
+            run += 1
+            continue
+        while run:  # run = sum of (digit + 1) * 2**k over its digits, least significant first
+            run -= 1
+            y.append(RUNA if run & 1 == 0 else RUNB)
+            run >>= 1
+        if a < ESCAPE - 1:
+            y.append(a + 1)
+        else:
+            y.append(ESCAPE)
+            y.append(a - ESCAPE + 1)
+    while run:
+        run -= 1
+        y.append(RUNA if run & 1 == 0 else RUNB)
+        run >>= 1
+    return bytes(y)
+
+
+def rle0_decode(y):
+    x = bytearray()
+    run, weight = 0, 1
+    escaped = False
+    for a in y:
+        if escaped:
+            x.append(a + ESCAPE - 1)
+            escaped = False
+        elif a <= RUNB:
+            run += (a + 1) * weight
+            weight <<= 1
+            continue
+        else:
+            if run:
+                x += bytes(run)
+                run, weight = 0, 1
+            if a == ESCAPE:
+                escaped = True
+            else:
+                x.append(a - 1)
+    x += bytes(run)
+    return bytes(x)
+
+
+def transform(x):
+    """Returns the BWT, move-to-front and zero run-length coding of the bytes x,
+    and the primary index needed to invert it"""
+    y, primary = bwt(x)
+    return rle0_encode(mtf_encode(y)), primary
+
+
+def inverse_transform(y, primary):
+    return inverse_bwt(mtf_decode(rle0_decode(y)), primary)
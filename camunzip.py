@@ -2,75 +2,53 @@ from trees import *
 from vl_codes import *
 import arithmetic
 import contextual_arithmetic
-from json import load
-from sys import argv, exit
-import json
+from container import decompress_stream
+from camzipfile import read_range
+from batch import decompress_files, MANIFEST
+from instrumentation import ProgressReporter
+from model_registry import REGISTRY_DIR
+from sys import argv, stdin, stdout, stderr
+from argparse import ArgumentParser
+from glob import has_magic
+import os
 
 
-def camunzip(filename, cond_prob_dict_filename=' ', cum_prob_dict_filename=' ', orig_message_filename=' '):
-    if not filename[-1] == 'z':
-        if filename[-1] == 'h':
-            method = 'huffman'
-        elif filename[-1] == 's':
-            method = 'shannon_fano'
-        elif filename[-1] == 'a':
-            method = 'arithmetic'
-        else:
-            raise NameError('Unknown compression method')
+def camunzip(filename, jobs=1, reporter=None, registry=REGISTRY_DIR):
+    if filename == '-':  # pipe from stdin to stdout
+        decompress_stream(stdin.buffer, stdout.buffer, jobs, reporter, registry)
+        return
 
-        with open(filename, 'rb') as fin:
-            y = fin.read()
-        y = bytes2bits(y)
+    # '.cuz' for Cam UnZipped (don't want to overwrite the original file...)
+    outfile = filename[:-4] + '.cuz'
 
-        pfile = filename[:-1] + 'p'
-        with open(pfile, 'r') as fp:
-            frequencies = load(fp)
-        n = sum([frequencies[a] for a in frequencies])
-        p = dict([(int(a),frequencies[a]/n) for a in frequencies])
-
-        if method == 'huffman' or method == 'shannon_fano':
-            if method == 'huffman':
-                xt = huffman(p)
-                c = xtree2code(xt)
-            else:
-                c = shannon_fano(p)
-                xt = code2xtree(c)
-
-            x = vl_decode(y, xt)
-
-        elif method == 'arithmetic':
-            x = arithmetic.decode(y,p,n)
-
-        else:
-            raise NameError('This will never happen (famous last words)')
-
-        # '.cuz' for Cam UnZipped (don't want to overwrite the original file...)
-        outfile = filename[:-4] + '.cuz'
-
-
-
-    else:
-
-        with open('encoded_messages/' + filename + '_zipped.cz', 'r') as zipped_file:
-            with open('cond_prob_models/' + cond_prob_dict_filename, 'r') as cond_prob_file:
-                context_dict = json.load(cond_prob_file)
-            with open('cond_prob_models/' + cum_prob_dict_filename, 'r') as cum_prob_file:
-                cumulative_dict = json.load(cum_prob_file)
-            with open('text_files/' + orig_message_filename, 'r', encoding='utf-8-sig') as file:
-                original_message = file.read()
-            x = contextual_arithmetic.decode(bytes2bits(zipped_file.read()), context_dict, cumulative_dict,
-                                                                len(original_message))
-
-    with open(outfile, 'wb') as fout:
-        fout.write(bytes(x))
+    # the compression method and model of every block are read from the block headers
+    with open(filename, 'rb') as fin, open(outfile, 'wb') as fout:
+        decompress_stream(fin, fout, jobs, reporter, registry)
 
 
 if __name__ == "__main__":
-    if len(argv) != 2:
-        print('Usage: python %s filename\n' % argv[0])
-        print('Example: python %s hamlet.txt.czh' % argv[0])
-        print('or:      python %s hamlet.txt.czs' % argv[0])
-        print('or:      python %s hamlet.txt.cza' % argv[0])
-        exit()
-
-    camunzip(argv[1])
+    parser = ArgumentParser(epilog='Example: python %s hamlet.txt.czh' % argv[0])
+    parser.add_argument('filename', nargs='+', help='a .czh, .czs, .cza, .czd, .czo, .czn, .czr, .czb, .czw or .czc '
+                                                    'file, or - to pipe from stdin to stdout, or several files, '
+                                                    'directories or glob patterns to decompress in a batch')
+    parser.add_argument('--jobs', type=int, default=1, help='number of processes decompressing blocks in parallel '
+                                                            '(or files, in a batch)')
+    parser.add_argument('--registry', default=REGISTRY_DIR, help='shared model registry directory')
+    parser.add_argument('--range', nargs=2, type=int, metavar=('START', 'LENGTH'),
+                        help='write only LENGTH bytes from offset START to stdout, decoding just the blocks '
+                             'covering them')
+    parser.add_argument('--manifest', default=MANIFEST, help='summary of a batch written at the end')
+    parser.add_argument('--force', action='store_true', help='decompress files of a batch even if up to date')
+    parser.add_argument('--verbose', action='store_true', help='show progress and throughput on stderr')
+    args = parser.parse_args()
+
+    if args.range is not None:
+        stdout.buffer.write(read_range(args.filename[0], args.range[0], args.range[1], args.registry))
+    elif len(args.filename) > 1 or os.path.isdir(args.filename[0]) or has_magic(args.filename[0]):
+        decompress_files(args.filename, args.jobs, args.registry, args.force, args.manifest,
+                         stderr if args.verbose else None)
+    else:
+        reporter = ProgressReporter() if args.verbose else None
+        camunzip(args.filename[0], args.jobs, reporter, args.registry)
+        if reporter is not None:
+            reporter.summary()
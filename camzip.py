@@ -2,69 +2,97 @@ from trees import *
 from vl_codes import *
 import arithmetic
 import contextual_arithmetic
-from itertools import groupby
-from json import dump
-from sys import argv
-import json
+from container import compress_stream, check_params, BLOCK_SIZE, METHODS, SUBSTREAMS
+from batch import compress_files, MANIFEST
+from model_registry import REGISTRY_DIR
+from ppm import DEFAULT_ORDER
+from instrumentation import ProgressReporter
+from sys import argv, stdin, stdout, stderr
+from argparse import ArgumentParser
+from glob import has_magic
+import os
 
 
-def camzip(method, message_filename, context_chars=1, cond_prob_dict_filename=' ', cum_prob_dict_filename=' '):
+def make_params(model_filename=' ', order=DEFAULT_ORDER, streams=SUBSTREAMS, model_id=None, registry=REGISTRY_DIR,
+                max_length=None):
+    # blocks only reference the context model by name, it is loaded from cond_prob_models/
+    # a model_id (hex) makes every block reference that model in the registry
+    # instead of building and carrying its own
+    return {'model': model_filename, 'order': order, 'streams': streams, 'registry': registry,
+            'model_id': bytes.fromhex(model_id) if model_id else None, 'max_length': max_length}
 
-    if not method == 'contextual arithmetic':
-        with open(message_filename, 'rb') as fin:
-            x = fin.read()
-
-        frequencies = dict([(key, len(list(group))) for key, group in groupby(sorted(x))])
-        n = sum([frequencies[a] for a in frequencies])
-        p = dict([(a,frequencies[a]/n) for a in frequencies])
-
-        if method == 'huffman' or method == 'shannon_fano':
-            if (method == 'huffman'):
-                xt = huffman(p)
-                c = xtree2code(xt)
-            else:
-                c = shannon_fano(p)
-                xt = code2xtree(c)
-
-            y = vl_encode(x, c)
-
-        elif method == 'arithmetic':
-            y = arithmetic.encode(x,p)
-        else:
-            raise NameError('Compression method %s unknown' % method)
-
-        y = bytes(bits2bytes(y))
 
-        outfile = message_filename + '.cz' + method[0]
+def camzip(method, message_filename, model_filename=' ', block_size=BLOCK_SIZE, jobs=1, order=DEFAULT_ORDER,
+           reporter=None, streams=SUBSTREAMS, model_id=None, registry=REGISTRY_DIR, index=False, max_length=None):
 
-        with open(outfile, 'wb') as fout:
-            fout.write(y)
-
-        pfile = message_filename + '.czp'
-        n = len(x)
-
-        with open(pfile, 'w') as fp:
-            dump(frequencies, fp)
+    params = make_params(model_filename, order, streams, model_id, registry, max_length)
+    check_params(method, params)  # before the output is opened, so a bad method or shared model leaves no file behind
 
+    if not method == 'contextual arithmetic':
+        infile = message_filename
+        outfile = message_filename + '.cz' + METHODS[method].decode().lower()
     else:
-        with open('cond_prob_models/' + cond_prob_dict_filename, 'r') as cond_prob_file:
-            context_dict = json.load(cond_prob_file)
-        with open('cond_prob_models/' + cum_prob_dict_filename, 'r') as cum_prob_file:
-            cumulative_dict = json.load(cum_prob_file)
-        with open('text_files/' + message_filename, 'r', encoding='utf-8-sig') as file:
-            original_message = file.read()
-        with open('encoded_messages/' + message_filename + '_zipped.cz', 'w') as zipped_file:
-            zipped_message = bytes(bits2bytes(contextual_arithmetic.encode(original_message, context_dict, cumulative_dict, context_chars)))
-            zipped_file.write(str(zipped_message))
+        infile = 'text_files/' + message_filename
+        outfile = 'encoded_messages/' + message_filename + '.czc'
+
+    # the input is read and compressed one block at a time, each block carrying
+    # its own model, so memory use is bounded by block_size and blocks can be
+    # compressed by jobs processes in parallel
+    if message_filename == '-':  # pipe from stdin to stdout
+        compress_stream(stdin.buffer, stdout.buffer, method, block_size, jobs, params, reporter, index)
+        return
+
+    # written to a temporary name and renamed once complete, so a failure part way
+    # (such as a code length limit too small for the data) leaves any earlier output intact
+    try:
+        with open(infile, 'rb') as fin, open(outfile + '.part', 'wb') as fout:
+            compress_stream(fin, fout, method, block_size, jobs, params, reporter, index)
+    except BaseException:
+        if os.path.exists(outfile + '.part'):
+            os.remove(outfile + '.part')
+        raise
+    os.replace(outfile + '.part', outfile)
 
 
 if __name__ == "__main__":
-    if (len(argv) != 3):
-        print('Usage: python %s compression_method filename\n' % argv[0])
-        print('Example: python %s huffman hamlet.txt' % argv[0])
-        print('or:      python %s shannon_fano hamlet.txt' % argv[0])
-        print('or:      python %s arithmetic hamlet.txt' % argv[0])
-        exit()
-
-    camzip(argv[1], argv[2])
-
+    parser = ArgumentParser(epilog='Example: python %s huffman hamlet.txt' % argv[0])
+    parser.add_argument('compression_method', help='huffman, shannon_fano, arithmetic, adaptive_arithmetic, '
+                                                   'ppm, ans, range_coder, huffman_interleaved, '
+                                                   'shannon_fano_interleaved, bwt_huffman, bwt_arithmetic or '
+                                                   '"contextual arithmetic"')
+    parser.add_argument('filename', nargs='+', help='file to compress, or - to pipe from stdin to stdout, or several '
+                                                    'files, directories or glob patterns to compress in a batch')
+    parser.add_argument('--jobs', type=int, default=1, help='number of processes compressing blocks in parallel '
+                                                            '(or files, in a batch)')
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE, help='bytes per independently compressed block')
+    parser.add_argument('--model', default=' ', help='context model in cond_prob_models/, needed for contextual '
+                                                    'arithmetic unless --model-id is given')
+    parser.add_argument('--order', type=int, default=DEFAULT_ORDER, help='maximum context order for ppm')
+    parser.add_argument('--streams', type=int, default=SUBSTREAMS,
+                        help='substreams per block for the interleaved methods')
+    parser.add_argument('--model-id', help='id of a shared model in the registry to code every block with '
+                                           '(see model_registry.py)')
+    parser.add_argument('--registry', default=REGISTRY_DIR, help='shared model registry directory')
+    parser.add_argument('--max-code-length', type=int, help='longest huffman codeword allowed, which bounds the '
+                                                                 'decode tables (--verbose shows what it costs)')
+    parser.add_argument('--index', action='store_true', help='end the file with a block index so that camunzip '
+                                                             '--range decodes slices of it quickly')
+    parser.add_argument('--manifest', default=MANIFEST, help='summary of a batch written at the end')
+    parser.add_argument('--force', action='store_true', help='compress files of a batch even if up to date')
+    parser.add_argument('--verbose', action='store_true', help='show progress and throughput on stderr')
+    args = parser.parse_args()
+
+    if len(args.filename) > 1 or os.path.isdir(args.filename[0]) or has_magic(args.filename[0]):
+        params = make_params(args.model, args.order, args.streams, args.model_id, args.registry, args.max_code_length)
+        compress_files(args.filename, args.compression_method, args.block_size, args.jobs, params, args.force,
+                       args.manifest, stderr if args.verbose else None, args.index)
+    else:
+        reporter = ProgressReporter() if args.verbose else None
+        camzip(args.compression_method, args.filename[0], args.model, args.block_size, args.jobs, args.order,
+               reporter, args.streams, args.model_id, args.registry, args.index, args.max_code_length)
+        if reporter is not None:
+            reporter.summary()
+            if 'limited_bits' in reporter.counts:
+                stderr.write('  length limit costs %.4f bits/byte over unconstrained huffman\n' %
+                             ((reporter.counts['limited_bits'] - reporter.counts['huffman_bits']) /
+                              max(reporter.original_bytes, 1)))
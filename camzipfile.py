@@ -0,0 +1,190 @@
+"""In-memory and file-like access to CamZIP data, in the style of the gzip module.
+
+compress and decompress work on bytes objects, with no file names involved:
+
+    blob = compress(payload, 'huffman')
+    payload = decompress(blob)
+
+read_range decodes any slice of a CamZIP file, reading only the blocks that
+cover it, and CamZipFile wraps any binary file object (or opens a file by name) so that
+data can be written or read incrementally, one container block at a time:
+
+    with CamZipFile('hamlet.txt.czh', 'wb', method='huffman') as f:
+        f.write(data)
+    with CamZipFile('hamlet.txt.czh') as f:
+        first = f.read(100)
+"""
+import builtins
+import io
+from container import BLOCK_SIZE, check_params, compress_stream, decompress_stream, write_header, read_header, \
+    write_block, read_block, encode_block, decode_block, decode_range
+
+
+def compress(data, method='huffman', block_size=BLOCK_SIZE, jobs=1, params=None, reporter=None, index=False):
+    """Returns the bytes data compressed with method as a CamZIP container.
+    params are the method options of container.encode_block, index adds a block index."""
+    out = io.BytesIO()
+    compress_stream(io.BytesIO(data), out, method, block_size, jobs, params, reporter, index)
+    return out.getvalue()
+
+
+def decompress(blob, jobs=1, reporter=None, registry=None):
+    """Inverse of compress, looking shared models up in the registry directory registry"""
+    out = io.BytesIO()
+    decompress_stream(io.BytesIO(blob), out, jobs, reporter, registry)
+    return out.getvalue()
+
+
+def read_range(archive, start, length, registry=None):
+    """Returns length bytes from offset start of the data compressed in archive,
+    a file name, bytes object or seekable binary file object, decoding only the
+    blocks covering them. This is quickest for files with a block index."""
+    if isinstance(archive, (bytes, bytearray)):
+        return decode_range(io.BytesIO(archive), start, length, registry)
+    if isinstance(archive, str) or hasattr(archive, '__fspath__'):
+        with builtins.open(archive, 'rb') as fin:
+            return decode_range(fin, start, length, registry)
+    return decode_range(archive, start, length, registry)
+
+
+class CamZipFile(io.BufferedIOBase):
+    """
+    Binary file object compressing what is written to it, or decompressing what
+    is read from it.
+
+    In write mode data is buffered until a whole block of block_size bytes can
+    be compressed with method, and the last, partial block is written on close.
+    In read mode blocks are decompressed one at a time as read asks for more
+    data, so memory use stays bounded by the block size whatever the file size.
+    fileobj, if given, is used instead of opening filename and is not closed.
+    Shared models (see model_registry) are looked up in the registry directory.
+    """
+
+    def __init__(self, filename=None, mode='rb', method='huffman', fileobj=None, block_size=BLOCK_SIZE,
+                 params=None, registry=None):
+        if mode not in ('r', 'rb', 'w', 'wb'):
+            raise ValueError('Invalid mode %r' % mode)
+        self.mode = 'rb' if mode.startswith('r') else 'wb'
+        if self.mode == 'wb':
+            check_params(method, params)  # before the file is opened, so nothing is left behind
+        if fileobj is None:
+            fileobj = builtins.open(filename, self.mode)
+            self._owned = True
+        else:
+            self._owned = False
+        self.fileobj = fileobj
+        self.name = filename if filename is not None else getattr(fileobj, 'name', '')
+
+        if self.mode == 'wb':
+            self.method = method
+            self.block_size = block_size
+            self.params = params
+            self._pending = bytearray()
+            write_header(fileobj)
+        else:
+            read_header(fileobj)
+            self.registry = registry
+            self._buffer = b''  # decompressed data not read yet
+            self._offset = 0
+            self._eof = False
+
+    def readable(self):
+        return self.mode == 'rb'
+
+    def writable(self):
+        return self.mode == 'wb'
+
+    def seekable(self):
+        return False
+
+    def _check(self, mode):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        if self.mode != mode:
+            raise io.UnsupportedOperation('File not open for %s' % ('reading' if mode == 'rb' else 'writing'))
+
+    def write(self, data):
+        self._check('wb')
+        data = memoryview(data).cast('B')
+        self._pending += data
+        while len(self._pending) >= self.block_size:
+            self._write_block(bytes(self._pending[:self.block_size]))
+            del self._pending[:self.block_size]
+        return len(data)
+
+    def _write_block(self, x):
+        write_block(self.fileobj, self.method, len(x), encode_block(self.method, x, self.params),
+                    (self.params or {}).get('model_id') is not None)
+
+    def _fill(self):
+        """Decompresses the next non-empty block into the buffer, returning False
+        at the end of the file"""
+        while not self._eof:
+            block = read_block(self.fileobj, self.registry)
+            if block is None:
+                self._eof = True
+                break
+            method, y, n = block
+            x = decode_block(method, y, n)
+            if len(x) != n:
+                raise NameError('Block decoded to %d bytes, expected %d' % (len(x), n))
+            if x:
+                self._buffer = self._buffer[self._offset:] + x
+                self._offset = 0
+                return True
+        return False
+
+    def read(self, size=-1):
+        self._check('rb')
+        if size is None or size < 0:
+            while self._fill():
+                pass
+        else:
+            while len(self._buffer) - self._offset < size and self._fill():
+                pass
+            size = min(size, len(self._buffer) - self._offset)
+            data = self._buffer[self._offset:self._offset + size]
+            self._offset += size
+            return data
+        data = self._buffer[self._offset:]
+        self._buffer, self._offset = b'', 0
+        return data
+
+    def read1(self, size=-1):
+        """Reads at most one block from the underlying file"""
+        self._check('rb')
+        if self._offset == len(self._buffer):
+            self._fill()
+        available = len(self._buffer) - self._offset
+        if size is None or size < 0 or size > available:
+            size = available
+        data = self._buffer[self._offset:self._offset + size]
+        self._offset += size
+        return data
+
+    def peek(self, size=0):
+        self._check('rb')
+        if self._offset == len(self._buffer):
+            self._fill()
+        return self._buffer[self._offset:]
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.mode == 'wb' and self._pending:
+                self._write_block(bytes(self._pending))
+                self._pending = bytearray()
+        finally:
+            try:
+                if self._owned:
+                    self.fileobj.close()
+            finally:
+                super().close()
+
+
+def open(filename, mode='rb', method='huffman', block_size=BLOCK_SIZE, params=None, registry=None):
+    """Opens a CamZIP file by name, or wraps a binary file object, as a CamZipFile"""
+    if isinstance(filename, (str, bytes)) or hasattr(filename, '__fspath__'):
+        return CamZipFile(filename, mode, method, None, block_size, params, registry)
+    return CamZipFile(None, mode, method, filename, block_size, params, registry)
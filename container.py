@@ -0,0 +1,569 @@
+"""Block-framed CamZIP container.
+
+The input is compressed in independent blocks of at most block_size bytes, so
+neither camzip nor camunzip ever hold more than one block (plus its compressed
+form) in memory. A file is laid out as
+
+    magic 'CZ' | version byte | block | block | ...
+
+and every block as
+
+    method byte | original length (4 bytes) | compressed length (4 bytes) | model | payload
+
+where the model is the code length table for huffman/shannon_fano, the symbol
+count table for arithmetic, ans and range_coder (quantised for the latter two), nothing for adaptive_arithmetic (whose model is
+rebuilt on the fly by the decoder), the model file name for contextual
+arithmetic and the context order for ppm, so each block can be decoded on its own. Because blocks
+are independent they can also be encoded and decoded in a pool of processes.
+
+The interleaved variants of huffman and shannon_fano split a block into a
+number of substreams coded with the same code, laid out as
+
+    code lengths | substreams (1 byte) | jump table | substream | substream | ...
+
+where the jump table holds the size of every substream but the last (4 bytes
+each) and substream k codes bytes k * n // substreams to (k + 1) * n // substreams
+of the block. Each substream, behind the code lengths, is a plain
+huffman/shannon_fano block of its own, so they can be decoded independently.
+
+The bwt variants of huffman and arithmetic code the block after the
+Burrows-Wheeler, move-to-front and zero run-length transforms (see bwt), as
+
+    block of the plain method coding the transformed bytes | primary index (4 bytes) |
+    transformed length (4 bytes)
+
+A block can also reference a shared model in a model registry (see
+model_registry) instead of carrying its model: the top bit of its method byte
+is set and the model is replaced by the 32 byte model id. A registered model
+of a STATIC method starts with the letter of the (plain) method it was built
+for, which is checked before it is used.
+
+The blocks can be followed by a block index, for random access: a record laid
+out as a block with method byte INDEX, the number of blocks and the record
+length, holding
+
+    (original offset (8 bytes) | block position (8 bytes)) per block |
+    original length (8 bytes) | record position (8 bytes) | 'CZIX'
+
+so a reader finds it from the last 12 bytes of the file. As every block
+carries (or references) its model and the coders restart at every block, the
+offsets are all the state needed to decode any block without the ones before.
+"""
+from bisect import bisect_right
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+import os
+from vl_codes import huffman_lengths, shannon_fano, canonical_code, lengths2bytes, bytes2lengths, \
+    vl_encode, vl_decode_table, make_decode_table, code_bits
+import arithmetic
+import adaptive_arithmetic
+import contextual_arithmetic
+import ppm
+import ans
+import range_coder
+import bwt
+from instrumentation import MetricsReporter, timed
+from model_registry import ModelRegistry, CACHE, REGISTRY_DIR, ID_SIZE
+
+MAGIC = b'CZ'
+VERSION = 1
+BLOCK_SIZE = 1 << 20
+HEADER_SIZE = 9
+
+# block method identifiers, which lower-cased are also the last letter of the .cz? extensions
+METHODS = {'huffman': b'h', 'shannon_fano': b's', 'arithmetic': b'a', 'contextual arithmetic': b'c',
+           'adaptive_arithmetic': b'd', 'ppm': b'o', 'ans': b'n',
+           'range_coder': b'r', 'huffman_interleaved': b'H', 'shannon_fano_interleaved': b'S',
+           'bwt_huffman': b'b', 'bwt_arithmetic': b'w'}
+METHOD_NAMES = dict([(METHODS[m][0], m) for m in METHODS])
+
+# the plain method every interleaved substream is coded with
+INTERLEAVED = {'huffman_interleaved': 'huffman', 'shannon_fano_interleaved': 'shannon_fano'}
+SUBSTREAMS = 4
+# the plain method coding the output of the transforms of the bwt methods
+BWT = {'bwt_huffman': 'huffman', 'bwt_arithmetic': 'arithmetic'}
+# methods whose model is a code length or count table computed from the block
+STATIC = ('huffman', 'shannon_fano', 'arithmetic', 'ans', 'range_coder') + tuple(INTERLEAVED)
+# set in the method byte of blocks that carry a model id instead of their model
+SHARED = 0x80
+# method byte of the block index record, and the magic number ending it
+INDEX = 0
+INDEX_MAGIC = b'CZIX'
+
+
+def _pack_name(name):
+    name = name.encode('utf-8')
+    if len(name) > 255:
+        raise NameError('Model name %s is too long' % name)
+    return bytes([len(name)]) + name
+
+
+def _unpack_name(y, offset):
+    return bytes(y[offset + 1:offset + 1 + y[offset]]).decode('utf-8'), offset + 1 + y[offset]
+
+
+def make_model(method, frequencies, max_length=None):
+    """Returns the packed model a block of one of the STATIC methods carries,
+    given the byte counts frequencies. max_length limits the length of the
+    huffman codewords."""
+    if method in ('huffman', 'shannon_fano') or method in INTERLEAVED:
+        n = sum(frequencies.values())
+        p = dict([(a, frequencies[a] / n) for a in sorted(frequencies)])
+        if INTERLEAVED.get(method, method) == 'huffman':
+            lengths = huffman_lengths(p, max_length)
+        else:
+            lengths = dict([(a, len(c)) for a, c in shannon_fano(p).items()])
+        # a lone symbol gets an empty codeword, which the stream could not be
+        # decoded from, so it is stored (and coded) with 1 bit
+        return lengths2bytes(dict([(a, max(1, lengths[a])) for a in lengths]))
+    elif method == 'arithmetic':
+        return arithmetic.frequencies2bytes(frequencies)
+    elif method == 'ans':
+        return arithmetic.frequencies2bytes(ans.quantise_frequencies(frequencies))
+    elif method == 'range_coder':
+        return arithmetic.frequencies2bytes(range_coder.quantise(frequencies))
+    raise NameError('Compression method %s has no static model' % method)
+
+
+def build_shared_model(method, samples, max_length=None):
+    """Builds a model of a STATIC method from the byte strings in samples, to
+    be registered in a model registry and shared by many files. Every byte value
+    is counted once more, so the model can code anything. The model starts with
+    the letter of the method, see shared_model."""
+    if method not in STATIC:
+        raise NameError('Compression method %s has no model to share' % method)
+    frequencies = Counter(range(256))
+    for x in samples:
+        frequencies.update(x)
+    return METHODS[INTERLEAVED.get(method, method)] + make_model(method, frequencies, max_length)
+
+
+def shared_model(method, mid, registry):
+    """Returns the model with id mid in the ModelRegistry registry for blocks of
+    method: the packed model of a STATIC method, once its letter shows it was
+    built for the method (an interleaved method using the models of its plain
+    method), or the path of a contextual arithmetic model file, once checked
+    against its id"""
+    if method == 'contextual arithmetic':
+        return registry.checked_path(mid)
+    if method not in STATIC:
+        raise NameError('Compression method %s has no model to share' % method)
+    model = registry.get(mid)
+    letter = METHODS[INTERLEAVED.get(method, method)]
+    if model[:1] != letter:
+        raise NameError('Model %s was not built for %s' % (mid.hex(), method))
+    return model[1:]
+
+
+def check_params(method, params):
+    """Raises NameError if blocks of method cannot be compressed with params,
+    so that nothing is written: the method must be known, a shared model
+    in the registry and built for the method, a code length limit at least 1,
+    a ppm order and a number of interleaved substreams that fit in the byte
+    the block stores them in. Contextual arithmetic needs a model, shared or
+    in cond_prob_models/."""
+    if method not in METHODS:
+        raise NameError('Compression method %s unknown' % method)
+    params = params or {}
+    if params.get('max_length') is not None and params['max_length'] < 1:
+        raise NameError('Codewords must be allowed at least 1 bit')
+    if method == 'ppm' and not 0 <= params.get('order', ppm.DEFAULT_ORDER) <= 255:
+        raise NameError('PPM orders between 0 and 255 are allowed')
+    if method in INTERLEAVED and not 1 <= params.get('streams', SUBSTREAMS) <= 255:
+        raise NameError('Between 1 and 255 substreams are allowed')
+    if params.get('model_id') is not None:
+        shared_model(method, params['model_id'], ModelRegistry(params.get('registry', REGISTRY_DIR)))
+    elif method == 'contextual arithmetic' and \
+            not os.path.isfile(contextual_arithmetic.model_path(params.get('model', ''))):
+        raise NameError('Contextual arithmetic needs a context model in cond_prob_models/ (--model)')
+
+
+def split_model(method, y):
+    """Returns the packed model at the start of the block y of a STATIC method
+    and the offset of the payload after it"""
+    if method in ('huffman', 'shannon_fano') or method in INTERLEAVED:
+        lengths, offset = bytes2lengths(y)
+    else:
+        frequencies, offset = arithmetic.bytes2frequencies(y)
+    return bytes(y[:offset]), offset
+
+
+def _coder(method, model, decoder=False):
+    """The code (or decode table) of a STATIC method, or the counts, to code
+    blocks with model, built once and kept in the model cache"""
+    def build():
+        if method in ('huffman', 'shannon_fano') or method in INTERLEAVED:
+            c = canonical_code(bytes2lengths(model)[0])
+            return make_decode_table(c) if decoder else c
+        return arithmetic.bytes2frequencies(model)[0]
+    return CACHE.get(('decoder' if decoder else 'coder', method, model), build)
+
+
+def encode_block(method, x, params=None, reporter=None):
+    """
+    Compresses the bytes x, returning the block model followed by the payload.
+
+    params is a dictionary of method options: 'model', the model file name in
+    cond_prob_models/ for contextual arithmetic, and 'order', the maximum
+    context order for ppm, 'streams', the number of substreams of the
+    interleaved methods, 'max_length', the longest codeword allowed in
+    huffman codes, and 'model_id', the id of a model in the model
+    registry in directory 'registry' (see model_registry) to use instead of
+    building one, in which case the block starts with the model id instead of
+    the model. reporter, if given, is told the time spent building the model
+    and encoding (see instrumentation), and with max_length the bits the
+    limited code takes and the bits an unconstrained huffman code would.
+    """
+    params = params or {}
+    shared = params.get('model_id')
+    if shared is not None and method not in STATIC and method != 'contextual arithmetic':
+        raise NameError('Compression method %s has no model to share' % method)
+    registry = ModelRegistry(params.get('registry', REGISTRY_DIR))
+
+    if method == 'contextual arithmetic':
+        with timed(reporter, 'model'):
+            if shared is not None:
+                model = contextual_arithmetic.load_model(shared_model(method, shared, registry))
+            else:
+                model = contextual_arithmetic.load_model(params['model'])
+        with timed(reporter, 'encode'):
+            y = contextual_arithmetic.encode(x, model, reporter)
+        return (shared if shared is not None else _pack_name(params['model'])) + y
+
+    elif method == 'adaptive_arithmetic':
+        with timed(reporter, 'encode'):
+            return adaptive_arithmetic.encode(x, reporter)
+
+    elif method == 'ppm':
+        order = params.get('order', ppm.DEFAULT_ORDER)
+        with timed(reporter, 'encode'):
+            return bytes([order]) + ppm.encode(x, order, reporter)
+
+    elif method in BWT:
+        with timed(reporter, 'transform'):
+            t, primary = bwt.transform(x)
+        return encode_block(BWT[method], t, params, reporter) + primary.to_bytes(4, 'big') + \
+            len(t).to_bytes(4, 'big')
+
+    elif method not in STATIC:
+        raise NameError('Compression method %s unknown' % method)
+
+    with timed(reporter, 'model'):
+        if shared is not None:
+            model = shared_model(method, shared, registry)
+        else:
+            frequencies = Counter(x)
+            model = make_model(method, frequencies, params.get('max_length'))
+            if reporter is not None and params.get('max_length') is not None and \
+                    INTERLEAVED.get(method, method) == 'huffman':
+                unconstrained = bytes2lengths(make_model(method, frequencies))[0]
+                reporter.count('limited_bits', code_bits(frequencies, bytes2lengths(model)[0]))
+                reporter.count('huffman_bits', code_bits(frequencies, unconstrained))
+        c = _coder(method, model)
+
+    with timed(reporter, 'encode'):
+        if method in ('huffman', 'shannon_fano'):
+            y = vl_encode(x, c)
+        elif method in INTERLEAVED:
+            streams = params.get('streams', SUBSTREAMS)
+            n = len(x)
+            parts = [vl_encode(x[k * n // streams:(k + 1) * n // streams], c) for k in range(streams)]
+            jump_table = b''.join([len(part).to_bytes(4, 'big') for part in parts[:-1]])
+            y = bytes([streams]) + jump_table + b''.join(parts)
+        elif method == 'arithmetic':
+            y = arithmetic.encode(x, c, reporter)
+        elif method == 'ans':
+            y = ans.encode(x, c, reporter)
+        else:
+            y = range_coder.encode(x, c, reporter)
+    return (shared if shared is not None else model) + y
+
+
+def substreams(method, y, n):
+    """Splits an interleaved block y of n original bytes into (method, block,
+    length) for each substream, every block being one of the plain method"""
+    lengths, offset = bytes2lengths(y)
+    model = bytes(y[:offset])
+    streams = y[offset]
+    offset += 1
+    sizes = [int.from_bytes(y[offset + 4 * k:offset + 4 * k + 4], 'big') for k in range(streams - 1)]
+    offset += 4 * (streams - 1)
+    sizes.append(len(y) - offset - sum(sizes))
+    if sizes[-1] < 0:
+        raise NameError('Corrupt substream jump table')
+    blocks = []
+    for k, size in enumerate(sizes):
+        blocks.append((INTERLEAVED[method], model + y[offset:offset + size],
+                       (k + 1) * n // streams - k * n // streams))
+        offset += size
+    return blocks
+
+
+def decode_block(method, y, n, reporter=None):
+    """Inverse of encode_block, n being the original length of the block (whose
+    model, if it was shared, has been put back by resolve_block)"""
+    if n == 0:
+        return b''
+
+    if method in STATIC:
+        with timed(reporter, 'model'):
+            model, offset = split_model(method, y)
+            c = _coder(method, model, decoder=True)
+        with timed(reporter, 'decode'):
+            if method in INTERLEAVED:  # one table serves every substream
+                return b''.join([bytes(vl_decode_table(s[offset:], c)) for m, s, k in substreams(method, y, n) if k])
+            elif method in ('huffman', 'shannon_fano'):
+                return bytes(vl_decode_table(y[offset:], c))
+            elif method == 'arithmetic':
+                return bytes(arithmetic.decode(y[offset:], c, n, reporter))
+            elif method == 'ans':
+                return ans.decode(y[offset:], c, n, reporter)
+            else:
+                return range_coder.decode(y[offset:], c, n, reporter)
+
+    if method == 'adaptive_arithmetic':
+        with timed(reporter, 'decode'):
+            return adaptive_arithmetic.decode(y, n, reporter)
+
+    elif method == 'ppm':
+        with timed(reporter, 'decode'):
+            return ppm.decode(y[1:], n, y[0], reporter)
+
+    elif method in BWT:
+        primary = int.from_bytes(y[-8:-4], 'big')
+        t = decode_block(BWT[method], y[:-8], int.from_bytes(y[-4:], 'big'), reporter)
+        with timed(reporter, 'transform'):
+            return bwt.inverse_transform(t, primary)
+
+    elif method == 'contextual arithmetic':
+        with timed(reporter, 'model'):
+            model_filename, offset = _unpack_name(y, 0)
+            model = contextual_arithmetic.load_model(model_filename)
+        with timed(reporter, 'decode'):
+            return contextual_arithmetic.decode(y[offset:], model, n, reporter)
+
+    raise NameError('Compression method %s unknown' % method)
+
+
+def write_header(fout):
+    fout.write(MAGIC + bytes([VERSION]))
+
+
+def read_header(fin):
+    header = fin.read(len(MAGIC) + 1)
+    if len(header) <= len(MAGIC) or header[:len(MAGIC)] != MAGIC:
+        raise NameError('Not a CamZIP file')
+    if header[len(MAGIC)] != VERSION:
+        raise NameError('Unsupported CamZIP version %d' % header[len(MAGIC)])
+
+
+def write_block(fout, method, n, y, shared=False):
+    """Writes the block header and the compressed block y of n original bytes,
+    shared meaning that y starts with a model id rather than the model"""
+    fout.write(bytes([METHODS[method][0] | (SHARED if shared else 0)]) + n.to_bytes(4, 'big') +
+               len(y).to_bytes(4, 'big'))
+    fout.write(y)
+    return len(y) + HEADER_SIZE
+
+
+def resolve_block(method, y, registry):
+    """Returns the block y of a shared model with the model id at its start
+    replaced by the model itself (for contextual arithmetic, by the name of the
+    model file in the registry), as if it had been written without sharing"""
+    mid = bytes(y[:ID_SIZE])
+    if len(mid) < ID_SIZE:
+        raise NameError('Truncated model id')
+    if method == 'contextual arithmetic':
+        return _pack_name(shared_model(method, mid, registry)) + y[ID_SIZE:]
+    return shared_model(method, mid, registry) + y[ID_SIZE:]
+
+
+def read_block(fin, registry=None):
+    """Returns (method, compressed block, original length) for the next block,
+    or None at the end of the file. Shared models are looked up in registry, a
+    ModelRegistry or its directory (REGISTRY_DIR by default)."""
+    header = fin.read(HEADER_SIZE)
+    if len(header) == 0 or header[0] == INDEX:
+        return None
+    if len(header) < HEADER_SIZE:
+        raise NameError('Truncated block header')
+    if header[0] & ~SHARED not in METHOD_NAMES:
+        raise NameError('Unknown compression method')
+    method = METHOD_NAMES[header[0] & ~SHARED]
+    n = int.from_bytes(header[1:5], 'big')
+    size = int.from_bytes(header[5:9], 'big')
+    y = fin.read(size)
+    if len(y) < size:
+        raise NameError('Truncated block')
+    if header[0] & SHARED:
+        if not isinstance(registry, ModelRegistry):
+            registry = ModelRegistry(registry or REGISTRY_DIR)
+        y = resolve_block(method, y, registry)
+    return method, y, n
+
+
+def write_index(fout, entries, length, position):
+    """Writes the block index record at position, the (original offset, block
+    position) of every block in entries and the original length of the file"""
+    index = b''.join([offset.to_bytes(8, 'big') + block.to_bytes(8, 'big') for offset, block in entries])
+    index += length.to_bytes(8, 'big') + position.to_bytes(8, 'big') + INDEX_MAGIC
+    fout.write(bytes([INDEX]) + len(entries).to_bytes(4, 'big') + len(index).to_bytes(4, 'big') + index)
+
+
+def read_index(fin):
+    """Returns the (original offset, block position) of every block of the
+    seekable file fin and the original length, from its block index or, if it
+    has none, by skipping from block header to block header"""
+    fin.seek(0, 2)
+    end = fin.tell()
+    if end >= len(MAGIC) + 1 + HEADER_SIZE + 12:
+        fin.seek(end - 12)
+        trailer = fin.read(12)
+        position = int.from_bytes(trailer[:8], 'big')
+        if trailer[8:] == INDEX_MAGIC and position < end:
+            fin.seek(position)
+            header = fin.read(HEADER_SIZE)
+            if header[:1] == bytes([INDEX]):
+                index = fin.read(int.from_bytes(header[5:9], 'big'))
+                entries = [(int.from_bytes(index[k:k + 8], 'big'), int.from_bytes(index[k + 8:k + 16], 'big'))
+                           for k in range(0, 16 * int.from_bytes(header[1:5], 'big'), 16)]
+                return entries, int.from_bytes(index[-20:-12], 'big')
+
+    fin.seek(0)
+    read_header(fin)
+    entries, offset = [], 0
+    while True:
+        position = fin.tell()
+        header = fin.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE or header[0] == INDEX:
+            return entries, offset
+        entries.append((offset, position))
+        offset += int.from_bytes(header[1:5], 'big')
+        fin.seek(int.from_bytes(header[5:9], 'big'), 1)
+
+
+def decode_range(fin, start, length, registry=None, reporter=None):
+    """Returns length bytes of the original file from offset start (fewer at its
+    end), decoding only the blocks of the seekable file fin that cover them.
+    Shared models are looked up in the registry directory registry."""
+    if start < 0 or length < 0:
+        raise NameError('Invalid range %d, %d' % (start, length))
+    entries, total = read_index(fin)
+    end = min(start + length, total)
+    out = bytearray()
+    k = bisect_right(entries, (start, float('inf'))) - 1
+    while start < end:
+        offset, position = entries[k]
+        fin.seek(position)
+        x = _decompress_job(*read_block(fin, registry), reporter)[0]
+        out += x[start - offset:end - offset]
+        start = offset + len(x)
+        k += 1
+    return bytes(out)
+
+
+def ordered_map(func, args, jobs=1):
+    """Yields func(*a) for every tuple a in args, in order. With more than one
+    job the calls run in a pool of processes, with at most 2 * jobs blocks in
+    flight so that memory stays bounded however long args is."""
+    if jobs <= 1:
+        for a in args:
+            yield func(*a)
+        return
+
+    with ProcessPoolExecutor(jobs) as executor:
+        pending = deque()
+        for a in args:
+            pending.append(executor.submit(func, *a))
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _job_reporter(reporter, jobs):
+    """Reporter to hand to a block job: the caller's own one when the job runs in
+    this process, otherwise a fresh MetricsReporter (reporters writing to a
+    stream can't be sent to a worker) whose measurements are merged back"""
+    if reporter is None or jobs <= 1:
+        return reporter
+    return MetricsReporter()
+
+
+def _merge(reporter, job_reporter):
+    if reporter is not None and job_reporter is not reporter:
+        reporter.merge(job_reporter)
+
+
+def _compress_job(method, x, params, reporter=None):
+    return len(x), encode_block(method, x, params, reporter), reporter
+
+
+def _decompress_job(method, y, n, reporter=None):
+    x = decode_block(method, y, n, reporter)
+    if len(x) != n:
+        raise NameError('Block decoded to %d bytes, expected %d' % (len(x), n))
+    return x, reporter
+
+
+def compress_stream(fin, fout, method, block_size=BLOCK_SIZE, jobs=1, params=None, reporter=None, index=False):
+    """Compresses the binary file object fin into fout one block at a time,
+    using jobs processes. params are passed on to encode_block, reporter (see
+    instrumentation) is told about the progress, timings and size of every block.
+    If index is set a block index is written at the end for read_range."""
+    check_params(method, params)
+    write_header(fout)
+    entries, offset, position = [], 0, len(MAGIC) + 1
+
+    def blocks():
+        while True:
+            with timed(reporter, 'read'):
+                x = fin.read(block_size)
+            if not x:
+                return
+            yield method, x, params, _job_reporter(reporter, jobs)
+
+    for n, y, job_reporter in ordered_map(_compress_job, blocks(), jobs):
+        _merge(reporter, job_reporter)
+        with timed(reporter, 'write'):
+            entries.append((offset, position))
+            offset += n
+            position += write_block(fout, method, n, y, (params or {}).get('model_id') is not None)
+        if reporter is not None:
+            reporter.block(n, len(y) + HEADER_SIZE)
+
+    if index:
+        write_index(fout, entries, offset, position)
+
+
+def decompress_stream(fin, fout, jobs=1, reporter=None, registry=None):
+    """Decompresses the binary file object fin into fout one block at a time,
+    using jobs processes, reporting to reporter as compress_stream does.
+    Shared models are looked up in the registry directory registry."""
+    read_header(fin)
+    sizes = deque()  # compressed sizes of the blocks in flight, in order
+
+    def blocks():
+        while True:
+            with timed(reporter, 'read'):
+                block = read_block(fin, registry)
+            if block is None:
+                return
+            if block[0] in INTERLEAVED and jobs > 1:
+                # the substreams are decoded as blocks of their own, so they are
+                # spread over the pool and their outputs come back in order
+                parts = substreams(*block)
+                sizes.extend([0] * (len(parts) - 1))
+            else:
+                parts = [block]
+            sizes.append(len(block[1]) + HEADER_SIZE)
+            for part in parts:
+                yield part + (_job_reporter(reporter, jobs),)
+
+    for x, job_reporter in ordered_map(_decompress_job, blocks(), jobs):
+        _merge(reporter, job_reporter)
+        size = sizes.popleft()
+        with timed(reporter, 'write'):
+            fout.write(x)
+        if reporter is not None:
+            reporter.block(len(x), size)
@@ -0,0 +1,420 @@
+"""Binary context model files for the contextual arithmetic coder.
+
+A model file holds integer symbol counts for every context of a fixed order,
+plus an order 0 table used before enough context is available. It is laid out
+as flat little-endian arrays so it can be memory mapped and only the pages of
+the contexts actually touched are read from disk:
+
+    header   magic 'CZM1' | order (4 bytes) | contexts (4 bytes) | entries (4 bytes) | padding to 32 bytes
+    keys     uint64 per context id, sorted
+    offsets  uint32 per context + 2: the entries of context i are offsets[i]:offsets[i + 1],
+             the order 0 table comes last
+    freqs    uint32 per entry
+    cums     uint32 per entry, cumulative count within the context
+    symbols  uint8 per entry, sorted within each context
+
+The raw counts a model is built from can be kept in a CountStore, so that it is
+retrained on new documents incrementally (see update_model).
+"""
+from bisect import bisect_left
+from functools import lru_cache
+from mmap import mmap, ACCESS_READ
+from array import array
+from sys import byteorder
+import json
+import os
+
+MAGIC = b'CZM1'
+HEADER_SIZE = 32
+# A context is identified by an integer holding its symbols SYMBOL_BITS apiece,
+# oldest first, so the coders can update it with a shift and a mask per symbol.
+SYMBOL_BITS = 8
+MAX_ORDER = 8  # context ids are stored as 64 bit keys
+# Counts are scaled down so that a context total never exceeds this, which keeps
+# every symbol interval non-empty in the 32 bit arithmetic coder.
+MAX_TOTAL = 1 << 24
+# Number of contexts whose decode tables are kept in memory at once
+CACHE_CONTEXTS = 1 << 14
+
+
+def context_id(symbols):
+    """Returns the integer id of a context given as a sequence of byte values"""
+    return int.from_bytes(bytes(symbols), 'big')
+
+
+def context_mask(order):
+    """Mask keeping the ids of rolling contexts to order symbols"""
+    return (1 << SYMBOL_BITS * order) - 1
+
+
+def _scale(frequencies):
+    total = sum(frequencies.values())
+    if total <= MAX_TOTAL:
+        return frequencies
+    return dict([(a, max(1, frequencies[a] * MAX_TOTAL // total)) for a in frequencies])
+
+
+def write_model(filename, order, counts, order0):
+    """
+    Writes a binary context model.
+
+    Parameters:
+    -----------
+    order: int
+    Number of context symbols
+
+    counts: dict
+    Maps each context id (see context_id) to a dictionary of symbol counts
+
+    order0: dict
+    Symbol counts used while there are fewer than order symbols of context
+    """
+    if order > MAX_ORDER:
+        raise ValueError('Context models are limited to %d context characters' % MAX_ORDER)
+
+    keys = array('Q')
+    offsets = array('I', [0])
+    freqs, cums, symbols = array('I'), array('I'), bytearray()
+    contexts = sorted(counts.items())
+    for key, frequencies in contexts + [(None, order0)]:
+        if key is not None:
+            keys.append(key)
+        context_freqs, context_cums, context_symbols = _context_tables(frequencies)
+        freqs += context_freqs
+        cums += context_cums
+        symbols += context_symbols
+        offsets.append(len(symbols))
+    _write_model_arrays(filename, order, keys, offsets, freqs, cums, symbols)
+
+
+def _context_tables(frequencies):
+    """The counts, cumulative counts and symbols stored for a context"""
+    frequencies = _scale(frequencies)
+    freqs, cums, symbols = array('I'), array('I'), bytearray()
+    cum = 0
+    for a in sorted(frequencies):
+        symbols.append(a)
+        freqs.append(frequencies[a])
+        cums.append(cum)
+        cum += frequencies[a]
+    return freqs, cums, symbols
+
+
+def _write_model_arrays(filename, order, keys, offsets, freqs, cums, symbols):
+    offsets = array('I', offsets)
+    if len(offsets) % 2:
+        offsets.append(0)  # keep the following arrays 8 byte aligned
+
+    keys, freqs, cums = array('Q', keys), array('I', freqs), array('I', cums)
+    if byteorder == 'big':
+        for a in (keys, offsets, freqs, cums):
+            a.byteswap()
+
+    header = MAGIC + order.to_bytes(4, 'little') + len(keys).to_bytes(4, 'little') + \
+        len(symbols).to_bytes(4, 'little')
+    with open(filename, 'wb') as fout:
+        fout.write(header.ljust(HEADER_SIZE, b'\0'))
+        for a in (keys, offsets, freqs, cums):
+            a.tofile(fout)
+        fout.write(symbols)
+
+
+def json2model(cond_prob_dict_filename, model_filename, resolution=1 << 16):
+    """
+    Converts a JSON conditional probability model written by build_contextual_dict
+    into a binary model. The cumulative JSON file is not needed as the cumulative
+    counts are recomputed. Probabilities are quantised to counts out of resolution,
+    keeping every symbol that had non-zero probability.
+
+    Models trained on latin-1 text convert exactly. Models trained on text
+    decoded as UTF-8 (as build_contextual_dict originally read it) have
+    characters that are not single bytes, so they are approximated: every
+    character stands for its UTF-8 bytes, a context keeps the last order bytes
+    of its characters and a symbol becomes the first byte of its character,
+    counts that end up on the same context and symbol being added up.
+    """
+    with open(cond_prob_dict_filename, 'r') as fp:
+        prob_cont_dict = json.load(fp)
+
+    characters = ''.join([context + ''.join(probs) for context, probs in prob_cont_dict.items()
+                          if context != 'no_context'] + list(prob_cont_dict.get('no_context', {})))
+    encoding = 'latin-1' if max(characters, default='\0') <= '\xff' else 'utf-8'
+
+    def quantise(probs, counts):
+        for a in probs:
+            if probs[a] > 0:
+                symbol = a.encode(encoding)[0]
+                counts[symbol] = counts.get(symbol, 0) + max(1, round(probs[a] * resolution))
+        return counts
+
+    order0 = quantise(prob_cont_dict.pop('no_context'), {})
+    orders = set([len(context) for context in prob_cont_dict])
+    if len(orders) > 1:
+        raise NameError('Contexts of different lengths in %s' % cond_prob_dict_filename)
+    order = orders.pop() if orders else 0
+    counts = {}
+    for context in prob_cont_dict:
+        encoded = context.encode(encoding)
+        key = context_id(encoded[len(encoded) - order:])
+        counts[key] = quantise(prob_cont_dict[context], counts.get(key, {}))
+    write_model(model_filename, order, counts, order0)
+
+
+class ContextModel:
+    """
+    Read-only, memory mapped view of a binary context model file.
+
+    tables(context) returns the symbols of a context as bytes and their
+    cumulative counts as a tuple ending with the context total, or None for a
+    context that never occurred in training. These are built
+    on first use and kept in an LRU cache of cache_size contexts, so the per
+    symbol work of the coders is one cache hit and a bisect.
+    """
+
+    def __init__(self, filename, cache_size=CACHE_CONTEXTS):
+        self.tables = lru_cache(maxsize=cache_size)(self._tables)
+        with open(filename, 'rb') as fin:
+            self.mm = mmap(fin.fileno(), 0, access=ACCESS_READ)
+        if self.mm[:len(MAGIC)] != MAGIC:
+            raise NameError('%s is not a CamZIP context model' % filename)
+        self.order = int.from_bytes(self.mm[4:8], 'little')
+        self.n_contexts = int.from_bytes(self.mm[8:12], 'little')
+        n_entries = int.from_bytes(self.mm[12:16], 'little')
+
+        n_offsets = self.n_contexts + 2
+        n_offsets += n_offsets % 2
+        sections = []
+        start = HEADER_SIZE
+        for size in (8 * self.n_contexts, 4 * n_offsets, 4 * n_entries, 4 * n_entries, n_entries):
+            sections.append((start, start + size))
+            start += size
+
+        self.view = view = memoryview(self.mm)
+        if byteorder == 'little':
+            self.keys, self.offsets, self.freqs, self.cums = [view[a:b].cast(fmt) for (a, b), fmt in
+                                                              zip(sections, ('Q', 'I', 'I', 'I'))]
+        else:  # no zero-copy view of little-endian data, so load and swap the arrays
+            self.keys, self.offsets, self.freqs, self.cums = [array(fmt, bytes(view[a:b])) for (a, b), fmt in
+                                                              zip(sections, ('Q', 'I', 'I', 'I'))]
+            for a in (self.keys, self.offsets, self.freqs, self.cums):
+                a.byteswap()
+        self.symbols_start = sections[4][0]
+
+    def context_range(self, context):
+        """Returns the (start, end) entries of a context given as its id, or of the
+        order 0 table if context is None"""
+        if context is None:
+            i = self.n_contexts
+        else:
+            i = bisect_left(self.keys, context)
+            if i == self.n_contexts or self.keys[i] != context:
+                raise KeyError(context)
+        return self.offsets[i], self.offsets[i + 1]
+
+    def total(self, start, end):
+        return self.cums[end - 1] + self.freqs[end - 1]
+
+    def _tables(self, context):
+        try:
+            start, end = self.context_range(context)
+        except KeyError:
+            return None
+        symbols = self.mm[self.symbols_start + start:self.symbols_start + end]
+        return symbols, tuple(self.cums[start:end]) + (self.total(start, end),)
+
+    def close(self):
+        self.tables.cache_clear()
+        for a in (self.keys, self.offsets, self.freqs, self.cums):
+            if isinstance(a, memoryview):
+                a.release()
+        self.view.release()
+        self.mm.close()
+
+
+def _extend(destination, source):
+    # copies the raw bytes of an array, memoryview or bytes slice, rather than element by element
+    if isinstance(destination, array):
+        destination.frombytes(bytes(source))
+    else:
+        destination += bytes(source)
+
+
+def _splice(keys, offsets, columns, updates):
+    """
+    Returns new keys, offsets and per entry columns (arrays or bytearrays) in
+    which the entries of the contexts in updates are replaced, or inserted in key
+    order if they are new. updates maps context ids, or None for the order 0
+    table, to a sequence of the context's values for each column. The runs of
+    contexts in between are copied slice by slice, so the Python work is
+    proportional to the number of updated contexts only.
+    """
+    n = len(keys)
+    new_keys, new_offsets = array('Q'), array('I', [0])
+    new_columns = [array(c.typecode) if isinstance(c, array) else bytearray() for c in columns]
+
+    def copy(p, q):  # contexts p:q of the old arrays
+        shift = len(new_columns[0]) - offsets[p]
+        _extend(new_keys, keys[p:q])
+        new_offsets.extend([o + shift for o in offsets[p + 1:q + 1]])
+        for new, old in zip(new_columns, columns):
+            _extend(new, old[offsets[p]:offsets[q]])
+
+    def insert(values):
+        for new, value in zip(new_columns, values):
+            _extend(new, value)
+        new_offsets.append(len(new_columns[0]))
+
+    p = 0
+    for key in sorted([key for key in updates if key is not None]):
+        q = bisect_left(keys, key, p)
+        copy(p, q)
+        new_keys.append(key)
+        insert(updates[key])
+        p = q + 1 if q < n and keys[q] == key else q
+    copy(p, n)
+    if None in updates:
+        insert(updates[None])
+    else:
+        insert([old[offsets[n]:offsets[n + 1]] for old in columns])
+    return new_keys, new_offsets, new_columns
+
+
+class CountStore:
+    """
+    Raw symbol counts of every document a context model was trained on, kept so
+    that new documents can be added without recounting the others.
+
+    The counts are laid out as in a model file, in flat arrays sorted by context
+    id with the order 0 table last, but are never scaled down. A store file is
+
+        header   magic 'CZT1' | order (4 bytes) | contexts (4 bytes) | entries (4 bytes) |
+                 documents (4 bytes) | padding to 32 bytes
+        digests  SHA-256 digest (32 bytes) per document added, so none is added twice
+        keys     uint64 per context id, sorted
+        offsets  uint32 per context + 2 (padded to an even number)
+        counts   uint64 per entry
+        symbols  uint8 per entry, sorted within each context
+    """
+
+    MAGIC = b'CZT1'
+
+    def __init__(self, order):
+        if order > MAX_ORDER:
+            raise ValueError('Context models are limited to %d context characters' % MAX_ORDER)
+        self.order = order
+        self.keys = array('Q')
+        self.offsets = array('I', [0, 0])
+        self.counts = array('Q')
+        self.symbols = bytearray()
+        self.documents = set()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def index(self, context):
+        """Position of the context id in keys (len(self) for None, the order 0
+        table), or None if the store has no counts for it"""
+        if context is None:
+            return len(self.keys)
+        i = bisect_left(self.keys, context)
+        return i if i < len(self.keys) and self.keys[i] == context else None
+
+    def frequencies(self, context):
+        """Symbol counts {symbol: count} of a context id, or of the order 0 table if context is None"""
+        i = self.index(context)
+        if i is None:
+            return {}
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return dict(zip(self.symbols[start:end], self.counts[start:end]))
+
+    def add(self, counts, order0, document):
+        """
+        Adds the counts of a document: counts maps context ids to symbol counts
+        and order0 holds its order 0 counts, as for write_model, and document is
+        its SHA-256 digest. Returns the set of context ids whose counts changed,
+        None standing for the order 0 table, which is empty if the document was
+        added before.
+        """
+        if document in self.documents:
+            return set()
+        updates = {}
+        for context, frequencies in list(counts.items()) + [(None, order0)]:
+            merged = self.frequencies(context)
+            for a in frequencies:
+                merged[a] = merged.get(a, 0) + frequencies[a]
+            symbols = sorted(merged)
+            updates[context] = (array('Q', [merged[a] for a in symbols]), bytes(symbols))
+        self.keys, self.offsets, (self.counts, self.symbols) = _splice(self.keys, self.offsets,
+                                                                        [self.counts, self.symbols], updates)
+        self.documents.add(document)
+        return set(updates)
+
+    def save(self, filename):
+        offsets = array('I', self.offsets)
+        if len(offsets) % 2:
+            offsets.append(0)
+        keys, counts = array('Q', self.keys), array('Q', self.counts)
+        if byteorder == 'big':
+            for a in (keys, offsets, counts):
+                a.byteswap()
+        header = self.MAGIC + b''.join([k.to_bytes(4, 'little') for k in
+                                        (self.order, len(keys), len(self.symbols), len(self.documents))])
+        with open(filename + '.tmp', 'wb') as fout:
+            fout.write(header.ljust(HEADER_SIZE, b'\0'))
+            fout.write(b''.join(sorted(self.documents)))
+            for a in (keys, offsets, counts):
+                a.tofile(fout)
+            fout.write(self.symbols)
+        os.replace(filename + '.tmp', filename)  # never leave a partly written store behind
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as fin:
+            data = fin.read()
+        if data[:len(cls.MAGIC)] != cls.MAGIC:
+            raise NameError('%s is not a CamZIP count store' % filename)
+        order, n_contexts, n_entries, n_documents = [int.from_bytes(data[k:k + 4], 'little') for k in range(4, 20, 4)]
+        store = cls(order)
+        start = HEADER_SIZE
+        store.documents = set([data[start + 32 * k:start + 32 * (k + 1)] for k in range(n_documents)])
+        start += 32 * n_documents
+        n_offsets = n_contexts + 2
+        arrays = []
+        for fmt, size in (('Q', n_contexts), ('I', n_offsets + n_offsets % 2), ('Q', n_entries)):
+            a = array(fmt)
+            a.frombytes(data[start:start + a.itemsize * size])
+            if byteorder == 'big':
+                a.byteswap()
+            arrays.append(a)
+            start += a.itemsize * size
+        store.keys, store.offsets, store.counts = arrays
+        del store.offsets[n_offsets:]
+        store.symbols = bytearray(data[start:start + n_entries])
+        return store
+
+
+def update_model(filename, store, changed=None):
+    """
+    Brings the binary model filename up to date with the count store, after the
+    contexts in changed (as returned by CountStore.add) were updated. Only the
+    tables of those contexts are rebuilt, the rest are copied from the existing
+    model. If changed is None, or there is no model yet, the whole model is
+    written from the store.
+    """
+    if changed is None or not os.path.exists(filename):
+        write_model(filename, store.order, dict([(key, store.frequencies(key)) for key in store.keys]),
+                    store.frequencies(None))
+        return
+
+    model = ContextModel(filename)
+    try:
+        if model.order != store.order:
+            raise NameError('%s is an order %d model, the counts are order %d' % (filename, model.order, store.order))
+        updates = dict([(key, _context_tables(store.frequencies(key))) for key in changed])
+        columns = [array('I', bytes(model.freqs)), array('I', bytes(model.cums)),
+                   model.mm[model.symbols_start:model.symbols_start + len(model.freqs)]]
+        keys, offsets, (freqs, cums, symbols) = _splice(model.keys, model.offsets, columns, updates)
+    finally:
+        model.close()
+    _write_model_arrays(filename + '.tmp', store.order, keys, offsets, freqs, cums, symbols)
+    os.replace(filename + '.tmp', filename)
@@ -1,74 +1,91 @@
-from itertools import groupby
+from collections import Counter
+from hashlib import sha256
 import json
-from typing import Dict
-from math import floor, ceil
-from sys import stdout as so
-from bisect import bisect
-from arithmetic import encode_rescale, decode_rescale, make_cumulative_dict
-from vl_codes import bits2bytes, bytes2bits
+import os
+from bisect import bisect_right
+from arithmetic import encode_rescale, decode_rescale, make_cumulative_dict, narrow, target, finish
+from bitstream import BitWriter, BitReader
+from instrumentation import progress_ranges
+from context_model import ContextModel, CountStore, write_model, update_model, context_id, context_mask, SYMBOL_BITS
+from model_registry import CACHE
+
+# Text is read as latin-1 so that every byte maps to exactly one character. This
+# lets the coder work on arbitrary blocks of a file without splitting multi-byte
+# characters, and the models trained from it cover every byte that can occur.
+TEXT_ENCODING = 'latin-1'
+
+# Every table is coded with an escape interval after its symbols, counting as
+# many as the table has symbols (as PPM method C does). A symbol missing from
+# its context's table, or a context that never occurred in training, is coded
+# as an escape and then with the order 0 table, and a symbol the order 0 table
+# lacks too as a second escape and then with UNIFORM, which holds every byte
+# and has no escape.
+UNIFORM = (bytes(range(256)), tuple(range(257)))
 
 
 def write_training_data(*filenames):
 
-    train_data = ''
+    train_data = b''
 
+    # the files are concatenated as bytes, with no newline translation, as the
+    # coder sees them
     for filename in filenames:
-        with open('text_files/' + filename, 'r') as file:
+        with open('text_files/' + filename, 'rb') as file:
             train_data += file.read()
 
-    with open("text_files/training_data.txt", "w+") as f:
+    with open("text_files/training_data.txt", "wb") as f:
         f.write(train_data)
 
 
+def model_path(model_filename):
+    """The path of a model in cond_prob_models/ (or model_filename itself, if absolute)"""
+    return os.path.join('cond_prob_models', model_filename)
+
+
+def load_model(model_filename):
+    """Opens a binary context model from cond_prob_models/ (or from anywhere given
+    an absolute path), keeping it in the model cache so later blocks in the same
+    process reuse the same memory map"""
+    path = model_path(model_filename)
+    return CACHE.get(('context model', os.path.abspath(path)), lambda: ContextModel(path), os.path.getsize(path))
+
+
+def count_contexts(symbols: bytes, context_char_no: int):
+    """
+    Counts every (context, symbol) pair in an integer symbol array in bulk.
+
+    The (context_char_no + 1)-grams are formed by zipping shifted copies of the
+    array and counted by Counter, so the per-symbol work happens in C. Only the
+    contexts that actually occur are stored, as a sparse dictionary mapping each
+    context id (see context_model.context_id) to a dictionary of symbol counts.
+    """
+    k = context_char_no
+    grams = Counter(zip(*[symbols[i:len(symbols) - k + i] for i in range(k + 1)]))
+
+    counts = {}
+    for gram, count in grams.items():
+        counts.setdefault(context_id(gram[:-1]), {})[gram[-1]] = count
+    return counts
+
+
 def build_contextual_dict(prob_cont_dict_filename, cum_prob_dict_filename, context_char_no=1,
                           training_data_filename='training_data.txt'):
-    if context_char_no > 4:
-        raise ValueError("Due to how this process scales we are only allowing up to 4 context characters")
-
-    with open("text_files/" + training_data_filename, "r", encoding='utf-8-sig') as training_file:
+    # reading the bytes is the same as reading latin-1 text, with symbol a standing for chr(a)
+    with open("text_files/" + training_data_filename, "rb") as training_file:
         training_data = training_file.read()
 
-    frequencies = dict([(key, len(list(group))) for key, group in groupby(sorted(training_data))])
-    Nin = sum([frequencies[a] for a in frequencies])
-    prob_no_context = dict([(a, frequencies[a]/Nin) for a in frequencies])
-
-    char_list = [character for character in frequencies]
-
-    # If more than one context character then there are many permutations possible
-    context_character_list = char_list
-    for i in range(context_char_no - 1):
-        prev_char_list = context_character_list
-        context_character_list = []
-        for element in prev_char_list:
-            for character in char_list:
-                context_character_list.append(element + character)
-
-    # Initialise as empty dictionary
-    contextual_dict = dict([(context_elements, dict([(character, 0) for character in char_list])) for context_elements in context_character_list])
-
-    # Count frequency of occurrences of characters in training data given certain contexts
-    for count, character in enumerate(training_data):
-        if count > context_char_no:
-            context_characters = ''
-            for cont_count in range(context_char_no):
-                ref = cont_count - context_char_no
-                context_characters += training_data[count + ref]
-            contextual_dict[context_characters][character] += 1
-
-        else:
-            pass
-
-    # Remove any contexts that do not occur and divide each frequency by the total given that condition to get probs
+    # Divide each frequency by the total given that condition to get probs
     prob_cont_dict = {}
-    for context_chars in contextual_dict:
-        Nin = sum([contextual_dict[context_chars][char] for char in char_list])
-        if not Nin == 0:
-            prob_cont_dict[context_chars] = dict([(char, contextual_dict[context_chars][char]/Nin)
-                                                  for char in char_list if contextual_dict[context_chars][char] > 0])
+    for context, frequencies in count_contexts(training_data, context_char_no).items():
+        Nin = sum(frequencies.values())
+        prob_cont_dict[context.to_bytes(context_char_no, 'big').decode(TEXT_ENCODING)] = dict([(chr(a), frequencies[a] / Nin)
+                                                                    for a in sorted(frequencies)])
 
-    # Write cumulative and normal conditional probability dictionaries to .json files to keep them permanently
-    prob_cont_dict['no_context'] = prob_no_context
+    frequencies = count_contexts(training_data, 0)[0]
+    Nin = sum(frequencies.values())
+    prob_cont_dict['no_context'] = dict([(chr(a), frequencies[a] / Nin) for a in sorted(frequencies)])
 
+    # Write cumulative and normal conditional probability dictionaries to .json files to keep them permanently
     with open('cond_prob_models/' + prob_cont_dict_filename, 'w') as fp:
         json.dump(prob_cont_dict, fp, sort_keys=True, indent=4)
 
@@ -77,142 +94,174 @@ def build_contextual_dict(prob_cont_dict_filename, cum_prob_dict_filename, conte
         json.dump(dict_of_cumulatives, fp, sort_keys=True, indent=4)
 
 
-def encode(input_message: str, cond_prob_dict: Dict, cumulative_prob_dict: Dict, context_char_no: int):
-    """"Encodes input_message using probabilities char_probs"""
+def build_context_model(model_filename, context_char_no=1, training_data_filename='training_data.txt'):
+    """Trains a model of the given order on text_files/training_data_filename and
+    writes it to cond_prob_models/model_filename in the binary model format"""
+    with open("text_files/" + training_data_filename, "rb") as training_file:
+        training_data = training_file.read()
+
+    write_model('cond_prob_models/' + model_filename, context_char_no, count_contexts(training_data, context_char_no),
+                count_contexts(training_data, 0)[0])
+
+
+def count_store_name(model_filename):
+    """The count store kept next to a model, e.g. cond_prob_models/context_model2.czt"""
+    return os.path.splitext(os.path.join('cond_prob_models', model_filename))[0] + '.czt'
+
+
+def train_context_model(model_filename, *filenames, context_char_no=1):
+    """
+    Adds the files in text_files/ to the training counts of the model
+    cond_prob_models/model_filename and brings the model up to date, creating
+    both if needed. The raw counts are persisted in a count store next to the
+    model, so only the new files are counted and only the tables of the contexts
+    they occur in are rebuilt: the cost is proportional to the new files, not to
+    everything the model was trained on before. Files already added are
+    skipped. A model with no count store is replaced by one trained on the
+    files. Returns the number of contexts whose tables changed.
+    """
+    model_path = os.path.join('cond_prob_models', model_filename)
+    store_path = count_store_name(model_filename)
+    fresh = not os.path.exists(store_path)
+    store = CountStore(context_char_no) if fresh else CountStore.load(store_path)
+    if store.order != context_char_no:
+        raise NameError('%s holds order %d counts' % (store_path, store.order))
+
+    changed = set()
+    for filename in filenames:
+        with open('text_files/' + filename, 'rb') as file:
+            data = file.read()
+        document = sha256(data).digest()
+        if document not in store.documents:
+            changed |= store.add(count_contexts(data, context_char_no), count_contexts(data, 0).get(0, {}), document)
+
+    if changed or not os.path.exists(model_path):
+        # the model is written before the store, so if this is interrupted the
+        # files are added again next time rather than missing from the model
+        # a model without a store (say from build_context_model or json2model) has
+        # no counts to add to, so it is rewritten from the new files alone rather
+        # than mixing their counts into some of its contexts
+        update_model(model_path, store, None if fresh else changed)
+        store.save(store_path)
+        CACHE.discard(('context model', os.path.abspath(model_path)))
+    return len(changed)
+
+
+def encode(input_message: bytes, model: ContextModel, reporter=None):
+    """"Encodes the bytes input_message using the context model"""
     precision = 32
     one = int(2 ** precision - 1)
-    quarter = int(ceil(one / 4))
-
-    compressed_message, lo, hi, straddle = [], 0, one, 0
-
-    for char_counter, msg_char in enumerate(input_message):  # for every symbol
-
-        # Progress bar
-        if char_counter % 100 == 0:
-            so.flush()
-            so.write('Arithmetic encoded %d%%    \r' % int(floor(char_counter / len(input_message) * 100)))
-
-        # When enough context exists to use full dictionary
-        context_characters = ''
-        if char_counter >= context_char_no:
-            for cont_count in range(context_char_no):
-                ref = cont_count - context_char_no
-                context_characters += input_message[char_counter + ref]
-        # Before there is sufficient context
-        else:
-            context_characters = 'no_context'
-
-        char_probs = cond_prob_dict[context_characters]
-        cum_prob_dict = cumulative_prob_dict[context_characters]
-
-        lohi_range = hi - lo + 1  # The added 1 is necessary to avoid rounding issues
-
-        # 2) narrow the interval end-points [lo,hi) to the new range [f,f+p]
-        # within the old interval [lo,hi], being careful to round 'innwards'
-        lo += ceil(cum_prob_dict[msg_char] * lohi_range)
-        hi = lo + floor(char_probs[msg_char] * lohi_range)
-
-        if lo == hi:
-            raise NameError('Zero interval!')
-
-        lo, hi, compressed_message, straddle = encode_rescale(lo, hi, compressed_message, one, straddle)
+    context_char_no = model.order
+    mask = context_mask(context_char_no)
+    order0 = model.tables(None)
+
+    compressed_message, lo, hi, straddle = BitWriter(), 0, one, 0
+    context = 0  # id of the last context_char_no symbols, updated in O(1) per symbol
+
+    for start, end in progress_ranges(len(input_message), reporter, 'Arithmetic encoded'):
+        for char_counter in range(start, end):  # for every symbol
+            msg_char = input_message[char_counter]
+
+            # When enough context exists to use full model, otherwise use the order 0 table
+            tables = model.tables(context) if char_counter >= context_char_no else order0
+            if tables is None:
+                # escaping from a context that never occurred costs nothing, as the
+                # decoder knows it never occurred
+                tables = order0
+            while True:
+                symbols, cums = tables
+                total = cums[-1]
+                j = symbols.find(msg_char)
+                if j != -1:
+                    escape = 0 if tables is UNIFORM else len(symbols)
+                    lo, hi = narrow(lo, hi, cums[j], cums[j + 1] - cums[j], total + escape)
+                    break
+                lo, hi = narrow(lo, hi, total, len(symbols), total + len(symbols))
+                lo, hi, compressed_message, straddle = encode_rescale(lo, hi, compressed_message, one, straddle)
+                tables = UNIFORM if tables is order0 else order0
+
+            context = ((context << SYMBOL_BITS) | msg_char) & mask
+            lo, hi, compressed_message, straddle = encode_rescale(lo, hi, compressed_message, one, straddle)
+
+    if reporter is not None:
+        reporter.count('renormalisations', len(compressed_message) + straddle)
 
     # termination bits - after processing all input symbols, flush any bits still in the 'straddle' pipeline
-    straddle += 1  # add 1 to straddle for "good measure" (ensures prefix-freeness)
-    if lo < quarter:  # the position of lo determines the dyadic interval that fits
-        compressed_message.append(0)
-        compressed_message += [1 for s in range(straddle)]
-    else:
-        compressed_message.append(1)
-        compressed_message += [0 for s in range(straddle)]
-
-    return compressed_message
+    return finish(compressed_message, lo, straddle, one)
 
 
-def decode(encoded_message: str, cond_prob_dict: Dict, cumulative_prob_dict: Dict,
-           num_chars: int, context_char_no: int):
+def decode(encoded_message: bytes, model: ContextModel, num_chars: int, reporter=None):
     precision = 32
     one = int(2 ** precision - 1)
+    context_char_no = model.order
+    mask = context_mask(context_char_no)
+    order0 = model.tables(None)
 
-    encoded_message.extend(precision * [0])  # dummy zeros to prevent index out of bound errors
-    input_message = num_chars * [0]  # initialise all zeros
+    if not isinstance(encoded_message, BitReader):
+        encoded_message = BitReader(encoded_message)
+    input_message = bytearray(num_chars)  # initialise all zeros
 
     # initialise by taking first 'precision' bits from y and converting to a number
-    value = int(''.join(str(a) for a in encoded_message[0:precision]), 2)
-    position = precision  # position where currently reading y
+    # (the reader pads with dummy zeros once the stream runs out)
+    value = encoded_message.read_bits(precision)
     lo, hi = 0, one
-
-    for char_counter in range(num_chars):
-
-        # When enough context exists to use full dictionary
-        context_characters = ''
-        if char_counter >= context_char_no:
-            for cont_count in range(context_char_no):
-                ref = cont_count - context_char_no
-                context_characters += input_message[char_counter + ref]
-        # Before there is sufficient context
-        else:
-            context_characters = 'no_context'
-
-        char_probs = list(cond_prob_dict[context_characters].values())
-        alphabet = list(cond_prob_dict[context_characters])
-        cum_prob = list(cumulative_prob_dict[context_characters].values())
-
-        if char_counter % 100 == 0:
-            so.flush()
-            so.write('Arithmetic decoded %d%%    \r' % int(floor(char_counter / num_chars * 100)))
-
-        lohi_range = hi - lo + 1
-        # This is an essential subtelty: the slowest part of the decoder is figuring out
-        # which symbol lands us in an interval that contains the encoded binary string.
-        # This can be extremely wasteful (o(n) where n is the alphabet size) if you proceed
-        # by simple looping and comparing. Here we use Python's "bisect" function that
-        # implements a binary search and is 100 times more efficient. Try
-        # for a = [a for a in f if f[a]<(value-lo)/lohi_range)][-1] for a MUCH slower solution.
-        a = bisect(cum_prob, (value - lo) / lohi_range) - 1
-        input_message[char_counter] = alphabet[a]
-
-        lo = lo + int(ceil(cum_prob[a] * lohi_range))
-        hi = lo + int(floor(char_probs[a] * lohi_range))
-
-        if lo == hi:
-            raise NameError('Zero interval!')
-
-        lo, hi, position, value = decode_rescale(lo, hi, encoded_message, position, one, value)
-
-    return input_message
+    context = 0  # id of the last context_char_no symbols, updated in O(1) per symbol
+
+    for start, end in progress_ranges(num_chars, reporter, 'Arithmetic decoded'):
+        for char_counter in range(start, end):
+            # The context's symbols and cumulative counts are built once and cached by
+            # the model, so the symbol search is just a binary search over the counts.
+            # Before there is enough context the order 0 table is used.
+            tables = model.tables(context) if char_counter >= context_char_no else order0
+            if tables is None:
+                tables = order0
+            while True:
+                symbols, cums = tables
+                total = cums[-1]
+                escape = 0 if tables is UNIFORM else len(symbols)
+                t = target(lo, hi, value, total + escape)
+                if t < total:
+                    break
+                lo, hi = narrow(lo, hi, total, escape, total + escape)
+                lo, hi, value = decode_rescale(lo, hi, encoded_message, one, value)
+                tables = UNIFORM if tables is order0 else order0
+            j = bisect_right(cums, t) - 1
+            a = symbols[j]
+            input_message[char_counter] = a
+
+            lo, hi = narrow(lo, hi, cums[j], cums[j + 1] - cums[j], total + escape)
+            context = ((context << SYMBOL_BITS) | a) & mask
+            lo, hi, value = decode_rescale(lo, hi, encoded_message, one, value)
+
+    if reporter is not None:
+        reporter.count('renormalisations', encoded_message.position - precision)
+
+    return bytes(input_message)
 
 
 def main():
-    # UNCOMMENT IF CHANGING TRAINING DATA
-    write_training_data('hamlet.txt', 'war_and_peace.txt', 'encyclopedia_britannica.txt', 'romeo_and_juliet.txt',
-                        'proj_gutenberg_encyclopedia.txt', 'great_expectations.txt')
-
     context_chars = 2
-    cond_prob_dict_filename = 'cond_prob_dict' + str(context_chars) + '.json'
-    cum_prob_dict_filename = 'cum_prob_dict' + str(context_chars) + '.json'
-    training_message_filename = 'training_data.txt'
+    model_filename = 'context_model' + str(context_chars) + '.czm'
     message_filename = 'war_and_peace.txt'
 
-    build_contextual_dict(cond_prob_dict_filename, cum_prob_dict_filename, context_chars, training_message_filename)
+    # only training files not added to the model before are counted
+    train_context_model(model_filename, 'hamlet.txt', 'war_and_peace.txt', 'encyclopedia_britannica.txt',
+                        'romeo_and_juliet.txt', 'great_expectations.txt', context_char_no=context_chars)
 
-    with open('cond_prob_models/' + cond_prob_dict_filename, 'r') as cond_prob_file:
-        context_dict = json.load(cond_prob_file)
-    with open('cond_prob_models/' + cum_prob_dict_filename, 'r') as cum_prob_file:
-        cumulative_dict = json.load(cum_prob_file)
-    with open('text_files/' + message_filename, 'r', encoding='utf-8-sig') as file:
+    model = load_model(model_filename)
+    with open('text_files/' + message_filename, 'rb') as file:
         original_message = file.read()
 
     print('Length of original string: ', len(original_message))
 
-    with open('encoded_messages/' + message_filename + '_zipped.cz', 'w') as zipped_file:
-        zipped_message = bytes(bits2bytes(encode(original_message, context_dict, cumulative_dict, context_chars)))
+    with open('encoded_messages/' + message_filename + '_zipped.cz', 'wb') as zipped_file:
+        zipped_message = encode(original_message, model)
         print('Length of compressed string: ', len(zipped_message))
         print(f'Compression rate: {8.0 * len(zipped_message)/ len(original_message)} bits/byte')
-        zipped_file.write(str(zipped_message))
+        zipped_file.write(zipped_message)
 
-    decompressed_message = decode(bytes2bits(zipped_message), context_dict, cumulative_dict, len(original_message), context_chars)
-    print(decompressed_message)
+    decompressed_message = decode(zipped_message, model, len(original_message))
+    print(decompressed_message == original_message)
 
     return 0
 
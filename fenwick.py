@@ -0,0 +1,57 @@
+class FenwickTree:
+    """
+    Binary indexed tree over the counts of symbols 0..n-1.
+
+    Updating a count, computing a cumulative count and finding the symbol whose
+    cumulative interval contains a given value all take O(log n), which is what
+    an adaptive arithmetic coder needs per symbol.
+    """
+
+    def __init__(self, counts):
+        self.n = len(counts)
+        self.freq = list(counts)
+        self.tree = [0] + list(counts)
+        # build in O(n) by pushing every partial sum up to its parent
+        for i in range(1, self.n + 1):
+            parent = i + (i & -i)
+            if parent <= self.n:
+                self.tree[parent] += self.tree[i]
+        self.total = sum(counts)
+        self.top = 1 << (self.n.bit_length() - 1) if self.n else 0  # highest power of 2 <= n
+
+    def add(self, symbol, delta):
+        """Adds delta to the count of symbol"""
+        self.total += delta
+        self.freq[symbol] += delta
+        i = symbol + 1
+        while i <= self.n:
+            self.tree[i] += delta
+            i += i & -i
+
+    def cumulative(self, symbol):
+        """Returns the sum of the counts of all symbols before symbol"""
+        cum = 0
+        i = symbol
+        while i > 0:
+            cum += self.tree[i]
+            i -= i & -i
+        return cum
+
+    def count(self, symbol):
+        return self.freq[symbol]
+
+    def find(self, target):
+        """Returns (symbol, cumulative) for the symbol with
+        cumulative <= target < cumulative + count"""
+        i, cum = 0, 0
+        step = self.top
+        while step:
+            nxt = i + step
+            if nxt <= self.n and cum + self.tree[nxt] <= target:
+                i = nxt
+                cum += self.tree[nxt]
+            step >>= 1
+        return i, cum
+
+    def counts(self):
+        return list(self.freq)
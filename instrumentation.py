@@ -0,0 +1,120 @@
+"""Progress and throughput instrumentation for camzip, camunzip and the coders.
+
+Everything that can be instrumented takes an optional reporter, None by default.
+With no reporter the coders run their symbol loops in one piece and nothing is
+measured, so there is no per-symbol cost. With a reporter they call
+reporter.progress every PROGRESS_INTERVAL symbols, and the container reports
+the time spent in each stage (model, encode/decode, the bwt transform,
+read/write), the number of interval renormalisations of the arithmetic coders
+and the size of every block.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+from time import perf_counter
+from sys import stderr
+
+PROGRESS_INTERVAL = 1 << 16
+
+
+class Reporter:
+    """Base class for reporters; every hook does nothing"""
+
+    def progress(self, stage, done, total):
+        """done out of total symbols have been processed by stage"""
+
+    def stage(self, name, seconds):
+        """seconds were spent in the named stage"""
+
+    def count(self, name, value):
+        """Adds value to the named counter"""
+
+    def block(self, original_bytes, compressed_bytes):
+        """A block of original_bytes was compressed to (or decompressed from) compressed_bytes"""
+
+    def merge(self, other):
+        """Adds the measurements of a MetricsReporter filled in by a worker process"""
+
+
+class MetricsReporter(Reporter):
+    """Accumulates stage timings, counters and block sizes"""
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.stages = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.original_bytes = 0
+        self.compressed_bytes = 0
+
+    def stage(self, name, seconds):
+        self.stages[name] += seconds
+
+    def count(self, name, value):
+        self.counts[name] += value
+
+    def block(self, original_bytes, compressed_bytes):
+        self.original_bytes += original_bytes
+        self.compressed_bytes += compressed_bytes
+
+    def merge(self, other):
+        for name in other.stages:
+            self.stages[name] += other.stages[name]
+        for name in other.counts:
+            self.counts[name] += other.counts[name]
+        self.original_bytes += other.original_bytes
+        self.compressed_bytes += other.compressed_bytes
+
+    def metrics(self):
+        """Returns the measurements so far as a dictionary"""
+        elapsed = perf_counter() - self.start
+        return {'seconds': elapsed,
+                'original_bytes': self.original_bytes,
+                'compressed_bytes': self.compressed_bytes,
+                'bytes_per_second': self.original_bytes / elapsed if elapsed > 0 else 0.0,
+                'bits_per_symbol': 8 * self.compressed_bytes / self.original_bytes if self.original_bytes else 0.0,
+                'stages': dict(self.stages),
+                'counts': dict(self.counts)}
+
+
+class ProgressReporter(MetricsReporter):
+    """MetricsReporter that also shows progress and a final summary on a text stream"""
+
+    def __init__(self, stream=stderr):
+        super().__init__()
+        self.stream = stream
+
+    def progress(self, stage, done, total):
+        self.stream.write('%s %d%%    \r' % (stage, 100 * done // total if total else 100))
+        self.stream.flush()
+
+    def summary(self):
+        m = self.metrics()
+        self.stream.write('%d bytes <-> %d bytes, %.3f bits/symbol, %.3f MB/s in %.2f s\n' %
+                          (m['original_bytes'], m['compressed_bytes'], m['bits_per_symbol'],
+                           m['bytes_per_second'] / 1e6, m['seconds']))
+        for name in sorted(m['stages']):
+            self.stream.write('  %-10s %.3f s\n' % (name, m['stages'][name]))
+        for name in sorted(m['counts']):
+            self.stream.write('  %-10s %d\n' % (name, m['counts'][name]))
+
+
+@contextmanager
+def timed(reporter, name):
+    """Reports the time spent in the with block as stage name, if there is a reporter"""
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        if reporter is not None:
+            reporter.stage(name, perf_counter() - start)
+
+
+def progress_ranges(n, reporter, stage):
+    """Splits range(n) into (start, end) pieces, reporting progress after each one.
+    Without a reporter the whole range comes back as a single piece."""
+    if reporter is None:
+        yield 0, n
+        return
+    for start in range(0, n, PROGRESS_INTERVAL):
+        end = min(start + PROGRESS_INTERVAL, n)
+        yield start, end
+        reporter.progress(stage, end, n)
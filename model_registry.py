@@ -0,0 +1,164 @@
+"""Content-addressed store of shared models, and the cache of built models.
+
+A model (the packed code lengths or counts a block would otherwise carry,
+after the letter of the method they were built for, or a binary context model
+file) is stored under the SHA-256 digest of its bytes, its model id, in a
+registry directory. Blocks compressed with a registered model only carry its
+id (see container), so many similar files can share one model and nobody has
+to count, build or store it again.
+
+Whatever is built from a model (code tables, decode tables, memory mapped
+context models) is kept in CACHE, an LRU cache bounded by the approximate
+number of bytes its entries take, so a batch of blocks or files using the
+same model builds it once per process.
+"""
+from argparse import ArgumentParser
+from collections import OrderedDict
+from hashlib import sha256
+import os
+import sys
+
+REGISTRY_DIR = 'model_registry'
+ID_SIZE = 32  # bytes of a model id
+CACHE_BYTES = 64 << 20
+
+
+def approximate_size(value):
+    """Rough number of bytes taken by value and the containers and strings in it"""
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        size += sum([approximate_size(v) for v in value])
+    elif isinstance(value, dict):
+        size += sum([approximate_size(k) + approximate_size(v) for k, v in value.items()])
+    return size
+
+
+class LRUCache:
+    """Cache evicting the least recently used entries once the sizes of the
+    entries add up to more than max_bytes"""
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key: (value, size)
+        self.total = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, build, size=None):
+        """Returns the value cached under key, calling build() to make it if there
+        is none. size is the cost of the value in bytes, or a function of the
+        value returning it, approximate_size by default."""
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+        value = build()
+        if size is None:
+            size = approximate_size(value)
+        elif callable(size):
+            size = size(value)
+        self.entries[key] = (value, size)
+        self.total += size
+        while self.total > self.max_bytes and len(self.entries) > 1:
+            old, (old_value, old_size) = self.entries.popitem(last=False)
+            self.total -= old_size
+        return value
+
+    def discard(self, key):
+        if key in self.entries:
+            self.total -= self.entries.pop(key)[1]
+
+    def clear(self):
+        self.entries.clear()
+        self.total = 0
+
+
+CACHE = LRUCache()
+
+
+def model_id(model):
+    """The id of the model bytes"""
+    return sha256(model).digest()
+
+
+class ModelRegistry:
+    """Models stored in a directory, one file per model named by its hex id"""
+
+    def __init__(self, directory=REGISTRY_DIR):
+        self.directory = os.path.abspath(directory)
+
+    def path(self, mid):
+        if len(mid) != ID_SIZE:
+            raise NameError('Model ids are %d bytes long' % ID_SIZE)
+        return os.path.join(self.directory, mid.hex())
+
+    def put(self, model):
+        """Stores the model bytes if they are not there already and returns their id"""
+        mid = model_id(model)
+        path = self.path(mid)
+        if not os.path.exists(path):
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path + '.tmp', 'wb') as fout:
+                fout.write(model)
+            os.replace(path + '.tmp', path)  # never leave a partly written model behind
+        return mid
+
+    def _open(self, mid):
+        try:
+            return open(self.path(mid), 'rb')
+        except FileNotFoundError:
+            raise NameError('Model %s is not in the registry %s' % (mid.hex(), self.directory))
+
+    def _check(self, mid, digest):
+        if digest != mid:
+            raise NameError('Model %s in %s is corrupt' % (mid.hex(), self.directory))
+
+    def get(self, mid):
+        """Returns the bytes of the model with id mid, checking them against it"""
+        def load():
+            with self._open(mid) as fin:
+                model = fin.read()
+            self._check(mid, model_id(model))
+            return model
+        return CACHE.get(('model', self.directory, bytes(mid)), load, len)
+
+    def checked_path(self, mid):
+        """Returns the path of the model with id mid, for models opened in place
+        (such as memory mapped context models), once the file has been checked
+        against the id. The file is hashed in chunks, once per process."""
+        def check():
+            digest = sha256()
+            with self._open(mid) as fin:
+                for chunk in iter(lambda: fin.read(1 << 20), b''):
+                    digest.update(chunk)
+            self._check(mid, digest.digest())
+            return self.path(mid)
+        return CACHE.get(('checked path', self.directory, bytes(mid)), check, 0)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(epilog='Example: python %s huffman text_files/hamlet.txt text_files/romeo_and_juliet.txt'
+                                   % sys.argv[0])
+    parser.add_argument('method', help='static method to build a shared model for (huffman, shannon_fano, '
+                                       'arithmetic, ans, range_coder or an interleaved method), or "file" to '
+                                       'register a model file such as a binary context model')
+    parser.add_argument('files', nargs='+', help='sample files the model is built from, or the model file')
+    parser.add_argument('--registry', default=REGISTRY_DIR, help='registry directory')
+    parser.add_argument('--max-code-length', type=int, help='longest huffman codeword allowed')
+    args = parser.parse_args()
+
+    registry = ModelRegistry(args.registry)
+    if args.method == 'file':
+        with open(args.files[0], 'rb') as fin:
+            mid = registry.put(fin.read())
+    else:
+        from container import build_shared_model
+        samples = []
+        for filename in args.files:
+            with open(filename, 'rb') as fin:
+                samples.append(fin.read())
+        mid = registry.put(build_shared_model(args.method, samples, args.max_code_length))
+    print(mid.hex())
@@ -0,0 +1,149 @@
+"""
+Adaptive PPM (prediction by partial matching) coder.
+
+Each symbol is coded in the longest context of at most max_order symbols that
+has been seen before. If the symbol has not followed that context yet an escape
+is coded and the next shorter context is tried, down to order 0 and finally a
+uniform order -1 over all bytes, so any input can be coded. Escape counts
+follow method C (the number of distinct symbols seen in the context), symbols
+already ruled out by a longer context are excluded from the shorter ones, and
+counts are updated after every symbol in the contexts from the order it was
+coded at upwards.
+"""
+from arithmetic import encode_rescale, decode_rescale, narrow, finish, target
+from bitstream import BitWriter, BitReader
+from context_model import context_mask, SYMBOL_BITS
+from instrumentation import progress_ranges
+
+
+ALPHABET_SIZE = 256
+DEFAULT_ORDER = 3
+MAX_COUNT = 1 << 16  # halve the counts of a context once one of them gets here
+
+
+def _update(contexts, masks, history, order, a, coded_order):
+    for o in range(max(coded_order, 0), order + 1):
+        ctx = history & masks[o]
+        stats = contexts[o].get(ctx)
+        if stats is None:
+            contexts[o][ctx] = {a: 1}
+            continue
+        stats[a] = stats.get(a, 0) + 1
+        if stats[a] >= MAX_COUNT:
+            for b in stats:
+                stats[b] = (stats[b] + 1) // 2
+
+
+def encode(input_message: bytes, max_order: int = DEFAULT_ORDER, reporter=None):
+    precision = 32
+    one = int(2**precision - 1)
+
+    compressed_message, lo, hi, straddle = BitWriter(), 0, one, 0
+    contexts = [{} for o in range(max_order + 1)]
+    masks = [context_mask(o) for o in range(max_order + 1)]
+    history = 0
+
+    for start, end in progress_ranges(len(input_message), reporter, 'PPM encoded'):
+        for k in range(start, end):
+            a = input_message[k]
+            order = min(k, max_order)  # longest context available so far
+            excluded = set()
+            coded_order = -1
+            for o in range(order, -1, -1):
+                stats = contexts[o].get(history & masks[o])
+                if stats is None:
+                    continue  # context never seen, the decoder knows not to expect an escape
+                cum, freq, total, distinct = 0, 0, 0, 0
+                for b, c in stats.items():
+                    if b in excluded:
+                        continue
+                    if b == a:
+                        cum, freq = total, c
+                    total += c
+                    distinct += 1
+                if distinct == 0:
+                    continue  # every symbol of the context was excluded
+                if freq:
+                    lo, hi = narrow(lo, hi, cum, freq, total + distinct)
+                    lo, hi, compressed_message, straddle = encode_rescale(lo, hi, compressed_message, one, straddle)
+                    coded_order = o
+                    break
+                # escape, whose count is the number of distinct symbols in the context
+                lo, hi = narrow(lo, hi, total, distinct, total + distinct)
+                lo, hi, compressed_message, straddle = encode_rescale(lo, hi, compressed_message, one, straddle)
+                excluded.update(stats)
+
+            if coded_order == -1:
+                # order -1: uniform over the bytes not excluded
+                cum = a - len([b for b in excluded if b < a])
+                lo, hi = narrow(lo, hi, cum, 1, ALPHABET_SIZE - len(excluded))
+                lo, hi, compressed_message, straddle = encode_rescale(lo, hi, compressed_message, one, straddle)
+
+            _update(contexts, masks, history, order, a, coded_order)
+            history = ((history << SYMBOL_BITS) | a) & masks[max_order]
+
+    if reporter is not None:
+        reporter.count('renormalisations', len(compressed_message) + straddle)
+
+    return finish(compressed_message, lo, straddle, one)
+
+
+def decode(encoded_message: bytes, num_chars: int, max_order: int = DEFAULT_ORDER, reporter=None):
+    precision = 32
+    one = int(2**precision - 1)
+
+    if not isinstance(encoded_message, BitReader):
+        encoded_message = BitReader(encoded_message)
+    input_message = bytearray(num_chars)
+    contexts = [{} for o in range(max_order + 1)]
+    masks = [context_mask(o) for o in range(max_order + 1)]
+    history = 0
+
+    value = encoded_message.read_bits(precision)
+    lo, hi = 0, one
+
+    for start, end in progress_ranges(num_chars, reporter, 'PPM decoded'):
+        for k in range(start, end):
+            order = min(k, max_order)
+            excluded = set()
+            coded_order = -1
+            for o in range(order, -1, -1):
+                stats = contexts[o].get(history & masks[o])
+                if stats is None:
+                    continue
+                candidates = [(b, c) for b, c in stats.items() if b not in excluded]
+                if len(candidates) == 0:
+                    continue
+                total = sum([c for b, c in candidates])
+                distinct = len(candidates)
+                t = target(lo, hi, value, total + distinct)
+                if t < total:
+                    cum = 0
+                    for b, c in candidates:
+                        if t < cum + c:
+                            break
+                        cum += c
+                    a = b
+                    lo, hi = narrow(lo, hi, cum, c, total + distinct)
+                    lo, hi, value = decode_rescale(lo, hi, encoded_message, one, value)
+                    coded_order = o
+                    break
+                lo, hi = narrow(lo, hi, total, distinct, total + distinct)
+                lo, hi, value = decode_rescale(lo, hi, encoded_message, one, value)
+                excluded.update(stats)
+
+            if coded_order == -1:
+                t = target(lo, hi, value, ALPHABET_SIZE - len(excluded))
+                remaining = [b for b in range(ALPHABET_SIZE) if b not in excluded]
+                a = remaining[t]
+                lo, hi = narrow(lo, hi, t, 1, ALPHABET_SIZE - len(excluded))
+                lo, hi, value = decode_rescale(lo, hi, encoded_message, one, value)
+
+            input_message[k] = a
+            _update(contexts, masks, history, order, a, coded_order)
+            history = ((history << SYMBOL_BITS) | a) & masks[max_order]
+
+    if reporter is not None:
+        reporter.count('renormalisations', encoded_message.position - precision)
+
+    return bytes(input_message)
@@ -0,0 +1,100 @@
+"""
+Range coder with integer frequencies and byte-wise renormalisation.
+
+The symbol counts are quantised to add up to 2**TOTAL_BITS, so narrowing the
+range is a shift and two integer multiplies, and whenever the range falls below
+2**24 the top byte of low is shifted out. A carry out of low can still change
+bytes already produced: the last byte is held back in cache along with the
+number of 0xff bytes after it, and they are only written once it is known
+whether a carry will ripple through them. Everything is integer arithmetic, so
+any platform decodes the same bytes. The decoder keeps code - low rather than
+low, which never carries, and finds the symbol with one table lookup.
+"""
+from ans import quantise_frequencies, cumulative_frequencies
+from instrumentation import progress_ranges
+
+TOTAL_BITS = 16
+TOP = 1 << 24  # renormalise when the range drops below this
+MASK = (1 << 32) - 1
+
+
+def quantise(frequencies):
+    """Scales counts {symbol: count} to integers adding up to 2**TOTAL_BITS"""
+    return quantise_frequencies(frequencies, TOTAL_BITS)
+
+
+def _shift_low(out, low, cache, pending):
+    """Shifts the top byte out of low, writing the bytes held back if no carry can
+    reach them any more. Returns the new low, cache and pending."""
+    if low < 0xff000000 or low > MASK:
+        carry = low >> 32
+        out.append((cache + carry) & 0xff)
+        out += bytes([(0xff + carry) & 0xff]) * pending
+        return (low << 8) & MASK, (low >> 24) & 0xff, 0
+    return (low << 8) & MASK, cache, pending + 1  # 0xff, which a carry would turn into 0x00
+
+
+def encode(x, frequencies, reporter=None):
+    """Encodes the byte string x with the quantised frequencies (see quantise)"""
+    cumulative = cumulative_frequencies(frequencies, 1 << TOTAL_BITS)
+    freq, cum = [0] * 256, [0] * 256
+    for a in frequencies:
+        freq[a], cum[a] = frequencies[a], cumulative[a]
+
+    out = bytearray()
+    low, rng = 0, MASK
+    cache, pending = 0, 0  # byte held back and the number of 0xff bytes after it
+
+    for start, end in progress_ranges(len(x), reporter, 'Range encoded'):
+        for a in x[start:end]:
+            r = rng >> TOTAL_BITS
+            low += r * cum[a]
+            rng = r * freq[a]
+            while rng < TOP:
+                rng <<= 8
+                low, cache, pending = _shift_low(out, low, cache, pending)
+
+    if reporter is not None:
+        reporter.count('renormalisations', len(out) + pending)
+
+    # flush the 4 bytes of low and whatever is still held back
+    for k in range(5):
+        low, cache, pending = _shift_low(out, low, cache, pending)
+    # the first byte out is the initial cache, which no carry can reach
+    return bytes(out[1:])
+
+
+def decode(y, frequencies, num_chars, reporter=None):
+    """Inverse of encode, returning num_chars bytes"""
+    cumulative = cumulative_frequencies(frequencies, 1 << TOTAL_BITS)
+    # symbol, cumulative count and count for every value of the count target
+    table = []
+    for a in cumulative:
+        table += [(a, cumulative[a], frequencies[a])] * frequencies[a]
+
+    code = int.from_bytes(y[:4], 'big')
+    position = 4
+    rng = MASK
+    output = bytearray(num_chars)
+
+    for start, end in progress_ranges(num_chars, reporter, 'Range decoded'):
+        for k in range(start, end):
+            r = rng >> TOTAL_BITS
+            t = code // r
+            if t >> TOTAL_BITS:
+                raise NameError('Unable to decompress')
+            a, c, f = table[t]
+            output[k] = a
+            code -= r * c
+            rng = r * f
+            while rng < TOP:
+                if position >= len(y):
+                    raise NameError('Unable to decompress')
+                code = (code << 8) | y[position]
+                rng <<= 8
+                position += 1
+
+    if reporter is not None:
+        reporter.count('renormalisations', position - 4)
+
+    return bytes(output)
@@ -1,7 +1,236 @@
+from array import array
+
+
+class Tree:
+    """
+    Rooted tree held in flat arrays, the representation used by the code
+    constructors and decoders.
+
+    Node n has parent parent[n] (-1 for the root) and label label[n], and its
+    children are child[n * arity:(n + 1) * arity], indexed by the code digit
+    leading to them, with -1 where there is none. Codes, decoding walks, depths
+    and Newick strings are all built in a single pass over the nodes.
+
+    Extended trees (xtrees), lists holding [parent, [children], label] for every
+    node, convert to and from it with to_xtree and from_xtree, and parent lists
+    with to_parents and from_parents.
+    """
+    __slots__ = ('arity', 'parent', 'child', 'label')
+
+    def __init__(self, arity=2):
+        self.arity = arity
+        self.parent = array('i')
+        self.child = array('i')
+        self.label = []
+
+    def __len__(self):
+        return len(self.parent)
+
+    def add(self, label=None, children=()):
+        """Adds a node whose children (existing, parentless nodes) are given in
+        digit order, -1 standing for none, and returns its index"""
+        n = len(self.parent)
+        self.parent.append(-1)
+        self.child.extend([-1] * self.arity)
+        self.label.append(label)
+        for digit, c in enumerate(children):
+            if c != -1:
+                self.child[n * self.arity + digit] = c
+                self.parent[c] = n
+        return n
+
+    def add_child(self, node, digit, label=None):
+        """Adds a node as child digit of node and returns its index"""
+        n = self.add(label)
+        self.child[node * self.arity + digit] = n
+        self.parent[n] = node
+        return n
+
+    def children(self, n):
+        """The children of node n in digit order, -1 standing for none"""
+        return self.child[n * self.arity:(n + 1) * self.arity]
+
+    def is_leaf(self, n):
+        return max(self.children(n)) == -1
+
+    def root(self):
+        if self.parent.count(-1) != 1:
+            raise NameError('Tree with no root or several roots')
+        return self.parent.index(-1)
+
+    def preorder(self):
+        """The nodes, every parent before its children"""
+        order = [self.root()]
+        arity, child = self.arity, self.child
+        for n in order:  # grows as it goes
+            order.extend([c for c in child[n * arity:(n + 1) * arity] if c != -1])
+        return order
+
+    def depths(self):
+        depth = [0] * len(self)
+        parent = self.parent
+        for n in self.preorder()[1:]:
+            depth[n] = depth[parent[n]] + 1
+        return depth
+
+    def code(self):
+        """Returns {label: codeword} for the leaves, the codeword being the list of
+        digits leading from the root to the leaf"""
+        arity, child = self.arity, self.child
+        codewords = {self.root(): []}
+        code = {}
+        for n in self.preorder():
+            codeword = codewords.pop(n)
+            children = child[n * arity:(n + 1) * arity]
+            if max(children) == -1:  # it's a leaf!
+                code[self.label[n]] = codeword
+            for digit, c in enumerate(children):
+                if c != -1:
+                    codewords[c] = codeword + [digit]
+        return code
+
+    def decode(self, y):
+        """Returns the labels of the leaves reached by walking down from the root
+        along the digits of y, back to the root after every leaf"""
+        arity, child, label = self.arity, self.child, self.label
+        leaf = [max(child[n * arity:(n + 1) * arity]) == -1 for n in range(len(self))]
+        # step[n * arity + k] is where digit k leads from node n: the offset of the
+        # child's own entries, ~child for a leaf, or None if the digit is unused
+        step = [None if c == -1 else ~c if leaf[c] else c * arity for c in child]
+        start = self.root() * arity
+        x = []
+        n = start
+        try:
+            for k in y:
+                if k >= arity:
+                    raise NameError('Symbol exceeds alphabet size in tree node')
+                n = step[n + k]
+                if n < 0:  # it's a leaf!
+                    x.append(label[~n])
+                    n = start
+        except TypeError:  # n is None
+            raise NameError('Symbol not assigned in tree node')
+        return x
+
+    def newick(self, labels=[]):
+        """Returns the tree in Newick format, see xtree2newick"""
+        if len(labels) == 0:
+            labels = _newick_labels(self.label)
+        arity, child = self.arity, self.child
+        strings = {}
+        for n in reversed(self.preorder()):  # children before their parents
+            children = [strings.pop(c) for c in child[n * arity:(n + 1) * arity] if c != -1]
+            if children:
+                strings[n] = '(' + ','.join(children) + ')%s' % labels[n]
+            else:
+                strings[n] = '%s' % labels[n]
+        return strings.popitem()[1]
+
+    @classmethod
+    def from_parents(cls, t, labels=[]):
+        """Tree of the parent list t, see tree2xtree for the labels"""
+        children = [[] for node in t]
+        for node in range(len(t)):
+            if t[node] != -1:
+                children[t[node]].append(node)
+        tree = cls(max([len(c) for c in children] + [1]))
+        tree.parent = array('i', t)
+        tree.child = array('i', [-1]) * (len(t) * tree.arity)
+        for node in range(len(t)):
+            tree.child[node * tree.arity:node * tree.arity + len(children[node])] = array('i', children[node])
+
+        # if tree only partially labeled or no labels, use partial labels
+        # and natural numbering for remaining nodes, starting from leaves first
+        if len(labels) < len(t):
+            leavesfirst = [k for k in range(len(t)) if len(children[k]) == 0]
+            leavesfirst.extend([k for k in range(len(t)) if len(children[k]) > 0])
+            xtlabels = [None] * len(t)
+            for k in range(len(t)):
+                xtlabels[leavesfirst[k]] = labels[k] if k < len(labels) else str(k)
+            labels = xtlabels
+        tree.label = list(labels[:len(t)])
+        return tree
+
+    @classmethod
+    def from_xtree(cls, xt):
+        tree = cls(max([len(node[1]) for node in xt] + [1]))
+        tree.parent = array('i', [node[0] for node in xt])
+        tree.child = array('i', [-1]) * (len(xt) * tree.arity)
+        for n, node in enumerate(xt):
+            tree.child[n * tree.arity:n * tree.arity + len(node[1])] = array('i', node[1])
+        tree.label = [node[2] if len(node) > 2 else None for node in xt]
+        return tree
+
+    @classmethod
+    def from_code(cls, c):
+        """Tree of the prefix code c, the nodes that are not codewords being
+        labelled by numbering them"""
+        tree = cls(max([2] + [digit + 1 for a in c for digit in c[a]]))
+        tree.add()  # init tree with just a root
+        codewords = set()
+        for symbol in c:
+            node = 0  # reset to root
+            for digit in c[symbol]:
+                child = tree.child[node * tree.arity + digit]
+                node = tree.add_child(node, digit) if child == -1 else child
+            tree.label[node] = symbol
+            codewords.add(node)
+
+        not_codeword_nodes = [k for k in range(len(tree)) if k not in codewords]
+        for k in range(len(not_codeword_nodes)):
+            tree.label[not_codeword_nodes[k]] = str(k)
+        return tree
+
+    def to_parents(self):
+        return list(self.parent)
+
+    def to_xtree(self):
+        xt = []
+        for n in range(len(self)):
+            children = list(self.children(n))
+            while children and children[-1] == -1:
+                children.pop()
+            xt.append([self.parent[n], children, self.label[n]])
+        return xt
+
+
+def _newick_labels(labels):
+    """Node labels as printed in Newick strings: symbols are shown as characters
+    and the characters with a meaning in the format are spelled out"""
+    try:
+        labels = [int(a) for a in labels]
+        if max(labels) < 128:
+            labels = [chr(a) for a in labels]
+    except ValueError:
+        labels = list(labels)
+    for k in range(len(labels)):
+        if labels[k] == ',':
+            labels[k] = 'comma'
+        elif labels[k] == '(':
+            labels[k] = 'left parenthesis'
+        elif labels[k] == ')':
+            labels[k] = 'right parenthesis'
+        elif labels[k] == '\n':
+            labels[k] = 'carriage return'
+        elif labels[k] == '|':
+            labels[k] = 'vertical bar'
+        elif labels[k] == ':':
+            labels[k] = 'colon'
+        elif labels[k] == ';':
+            labels[k] = 'semi-colon'
+        elif labels[k] == ' ':
+            labels[k] = 'space'
+        elif labels[k] == '[':
+            labels[k] = 'left square bracket'
+        elif labels[k] == ']':
+            labels[k] = 'right square bracket'
+    return labels
+
+
 def tree2newick(t, labels = []):
-    return(xtree2newick(tree2xtree(t, labels)))
+    return Tree.from_parents(t, labels).newick()
     
-def xtree2newick(xt, labels = [], n = -1):
+def xtree2newick(xt, labels = []):
     """
     Converts an extended tree to Newick format. 
     
@@ -12,9 +241,6 @@ def xtree2newick(xt, labels = [], n = -1):
     first element a pointer to its parent and the second element is a list
     containing pointers its children
 
-    n: int
-    USED INTERNALLY FOR RECURSION, DO NOT SET!
-
     Returns:
     --------
     string 
@@ -23,125 +249,25 @@ def xtree2newick(xt, labels = [], n = -1):
 
     Written by Jossy, 2018
     """
-
-    if len(labels) == 0:
-        try:
-            labels = [int(a[2]) for a in xt]
-            if max(labels) < 128:
-                labels = [chr(a) for a in labels]
-        except ValueError:
-            labels = [a[2] for a in xt]
-        for k in range(len(labels)):
-            if labels[k] == ',':
-                labels[k] = 'comma'
-            elif labels[k] == '(':
-                labels[k] = 'left parenthesis'
-            elif labels[k] == ')':
-                labels[k] = 'right parenthesis'
-            elif labels[k] == '\n':
-                labels[k] = 'carriage return'
-            elif labels[k] == '|':
-                labels[k] = 'vertical bar'
-            elif labels[k] == ':':
-                labels[k] = 'colon'
-            elif labels[k] == ';':
-                labels[k] = 'semi-colon'
-            elif labels[k] == ' ':
-                labels[k] = 'space'
-            elif labels[k] == '[':
-                labels[k] = 'left square bracket'
-            elif labels[k] == ']':
-                labels[k] = 'right square bracket'
-            
-    if (n == -1): # find root and set n to index of root
-        n = [ind for ind in range(len(xt)) if xt[ind][0] == -1]
-        if len(n) != 1:
-            raise NameError('Tree with no root or several roots')
-        n = n[0] # n is a list with 1 element, retrieve that element
-
-    # find the children of the current node
-    children = [a for a in xt[n][1] if a != -1]
-    # if the current node has no children, return its label
-    if len(children) == 0:
-        return '%(myname)s' % {'myname': labels[n]}
-    # for every child, recurse the function and separate its outcomes by commas
-    outstring = xtree2newick(xt,labels,children[0]) # first child
-    for k in range(1,len(children)): # remaining children
-        outstring = outstring + ',' + xtree2newick(xt,labels,children[k])
-
-    # surround the string by parenthesis and append the current node label
-    outstring = '(' + outstring + ')%(myname)s' % {'myname': labels[n]}
-    return outstring # return the resulting string
+    return Tree.from_xtree(xt).newick(labels)
 
 
 def tree2xtree(t, labels = []):
-    xt = [[] for node in t]
-    for node in range(len(t)):
-        children = [ind for ind in range(len(t)) if t[ind] == node]
-        xt[node].append(t[node])
-        xt[node].append(children)
-
-    # if tree only partially labeled or no labels, use partial labels
-    # and natural numbering for remaining nodes, starting from leaves first
-    if len(labels) < len(t):
-        xtlabels = [[] for k in range(len(t))]
-        leavesfirst = [k for k in range(len(xt)) if len(xt[k][1]) == 0]
-        leavesfirst.extend([k for k in range(len(xt)) if len(xt[k][1]) > 0])
-        for k in range(len(labels)):
-            xtlabels[leavesfirst[k]] = labels[k]
-        for k in range(len(labels),len(xt)):
-            xtlabels[leavesfirst[k]] = str(k)
-        labels = xtlabels
-    for node in range(len(xt)):
-        xt[node].append(labels[node])
-
-    return xt
+    return Tree.from_parents(t, labels).to_xtree()
 
 def xtree2tree(xt):
     return [node[0] for node in xt]
 
 def xtree2code(xt):
-    leaves = [ind for ind in range(len(xt)) if len(xt[ind][1]) == 0]
-    code = {}
-    for leaf in leaves:
-        codeword = []
-        node = leaf
-        while xt[node][0] != -1: # while node is not root
-            parent = xt[node][0] # node's parent
-            # which number child am I? 
-            nchild = [ind for ind in range(len(xt[parent][1])) if xt[parent][1][ind] == node]
-            codeword.insert(0, nchild[0])
-            node = parent
-        code[xt[leaf][2]] = codeword
-
-    return code
+    return Tree.from_xtree(xt).code()
 
     
 def tree2code(t, labels=[]):
-    return xtree2code(tree2xtree(t, labels))
+    return Tree.from_parents(t, labels).code()
 
 def code2xtree(c):
-    xt = [[-1, []]] # init tree with just a root
-    for symbol in c:
-        node = 0 # reset to root
-        for digit in c[symbol]:
-            while len(xt[node][1]) <= digit:
-                xt[node][1].append(-1)
-            if xt[node][1][digit] == -1:
-                # create new node
-                xt.append([node, []])
-                xt[node][1][digit] = len(xt)-1
-            node = xt[node][1][digit]
-        xt[node].append(symbol)
-
-    # label the nodes that are not codewords by numbering them
-    not_codeword_nodes = [k for k in range(len(xt)) if len(xt[k]) < 3]
-    for k in range(len(not_codeword_nodes)):
-        xt[not_codeword_nodes[k]].append(str(k))
-
-    return xt
+    return Tree.from_code(c).to_xtree()
 
     
 def code2tree(c):
-    return xtree2tree(code2xtree(c))
-
+    return Tree.from_code(c).to_parents()
@@ -1,4 +1,9 @@
 from math import log2, ceil
+from heapq import heapify, heappop, heappush, merge
+from bitstream import BitWriter, BitReader
+from trees import Tree
+
+ENCODE_CHUNK = 1 << 16  # symbols encoded at a time by vl_encode
 
 
 def shannon_fano(p):
@@ -47,118 +52,283 @@ def shannon_fano(p):
 
 
 def huffman(p):
-    # create an xtree with all the source symbols (to be the leaves) initially orphaned
-    xt = [[-1,[], a] for a in p]
-    # label the probabilities with a "pointer" to their corresponding nodes in the tree
-    # in the process, we convert the probability vector from a Python dictionary to a
-    # list of tuples (so we can modify it)
-    p = [(k, p[a]) for k, a in enumerate(p)]
-
-    # the leaves are labeled according to the symbols in the probability vector. We will
-    # label the remaining tree nodes (mainly for visualisation purposes) with numbers
-    # starting at len(p)
-    nodelabel = len(p)
-
-    # this loop will gradually increase the tree and reduce the probability list.
-    # It will run until there is only one probability left in the list (which probability
-    # will by then be 1.0)
-    while len(p) > 1:
-        # print('New round')
-        # sort probabilities in ascending order (so [0] and [1] are smallest)
-        # using the command "sorted" and, as its second element, the expression
-        #  "key = lambda el:el[1]" (which is an inline function to retrieve the
-        # second entry from a tuple.) Note that the natural order of "sorted" is
-        # increasing, which is as you want it in this case.
-        # The output of sorted() can be written back to p (i.e. p = sorted(p, ....))
-        p = sorted(p, key=lambda el: el[1])
-        # print('p = %s'%p)
-
-        # Now append a new node to the tree xt with no parent (parent = -1),
-        # no children (children = []) and label str(nodelabel)
-        xt.append([-1, [p[0][0], p[1][0]], str(nodelabel)])
-
-        # we incrase the variable nodelabel by 1 for its next use
-
-        # assign parent of the nodes pointed to by the smallest probabilities
-        # Note that the smallest probabilities are now p[0] and p[1], so their
-        # pointers to nodes in xt are p[0][0] and p[1][0]. The corresponding
-        # xt nodes should be assigned the new node you created as a parent,
-        # whose index is len(xt)-1 since it has been appended at the end of xt
-        # print('p[0][0] = %s'%p[0][0])
-        xt[p[0][0]][0] = nodelabel
-        xt[p[1][0]][0] = nodelabel
-
-        # assign the children of new node to be the nodes pointed to by
-        # p[0] and p[1]. Note that the new node can be addressed as xt[-1]
-
-        # create a new entry pointing to the new node in the list of probabilities
-        # This new entry should be a tuple with len(xt)-1 as its first element,
-        # and the sum of the probabilities in p[0] and p[1] as its second element
-        p.append((nodelabel, p[0][1] + p[1][1]))
-        # print('p = %s'%p)
-        # print('xt = %s'%xt)
-
-        nodelabel += 1
-        # remove the two nodes with the smallest probability
-        p.pop(0)
-        p.pop(0)
-        # (using pop(0) twice removes the first element of the list twice
-        # and hence removes the first 2 elements.)
-        
-    return xt
+    """Returns the Huffman code tree (see trees.Tree) of the probabilities p, the
+    leaves being nodes 0 to len(p) - 1 labelled with the symbols. to_xtree
+    converts it to an xtree for visualisation."""
+    # create a tree with all the source symbols (to be the leaves) initially orphaned
+    tree = Tree()
+    for a in p:
+        tree.add(a)
+    # keep the orphaned nodes in a heap ordered by probability, so that the two least
+    # probable ones can be retrieved in O(log n) rather than re-sorting the list on every
+    # merge. The node index breaks ties between equal probabilities, which also makes
+    # the resulting tree deterministic.
+    heap = [(p[a], k) for k, a in enumerate(p)]
+    heapify(heap)
+
+    # this loop will gradually increase the tree and reduce the heap.
+    # It will run until there is only one node left in the heap (the root)
+    while len(heap) > 1:
+        p0, n0 = heappop(heap)
+        p1, n1 = heappop(heap)
+
+        # the new node is labelled (mainly for visualisation purposes) with its index
+        nodelabel = tree.add(str(len(tree)), (n0, n1))
+
+        heappush(heap, (p0 + p1, nodelabel))
+
+    return tree
+
+
+def huffman_lengths(p, max_length=None):
+    """Returns the Huffman codeword length of every symbol with non-zero
+    probability, or if max_length is given and some are longer, the lengths of
+    the best code with none longer than max_length (see package_merge)"""
+    p = dict([(a, p[a]) for a in p if p[a] > 0])
+    if len(p) == 1:
+        return dict([(a, 1) for a in p])  # a lone symbol still needs one bit per occurrence
+    tree = huffman(p)
+    depth = tree.depths()
+    lengths = dict([(tree.label[k], depth[k]) for k in range(len(p))])
+    if max_length is not None and max(lengths.values()) > max_length:
+        return package_merge(p, max_length)
+    return lengths
+
+
+def package_merge(p, max_length):
+    """
+    Returns the codeword lengths of the optimal prefix code for the
+    probabilities p with no codeword longer than max_length bits.
+
+    Each symbol is a coin of its probability at every one of the max_length
+    bit positions. Going from the longest position up, the coins of a position
+    are paired off into packages, the cheapest first, and merged with the
+    coins of the next position. The 2n - 2 cheapest items at the last position
+    make the code: the length of a symbol is the number of its coins in them.
+    Takes O(n max_length) time for n symbols.
+    """
+    symbols = sorted([a for a in p if p[a] > 0], key=lambda a: (p[a], a))
+    n = len(symbols)
+    if n == 1:
+        return {symbols[0]: 1}
+    if n > 1 << max_length:
+        raise NameError('%d symbols do not fit in codewords of %d bits' % (n, max_length))
+
+    # an item is (weight, coins), coins being a symbol index or a pair of items' coins
+    coins = [(p[a], k) for k, a in enumerate(symbols)]
+    items = coins
+    for position in range(max_length - 1):
+        packages = [(items[i][0] + items[i + 1][0], (items[i][1], items[i + 1][1]))
+                    for i in range(0, len(items) - 1, 2)]
+        items = list(merge(coins, packages, key=lambda item: item[0]))
+
+    lengths = [0] * n
+    stack = [item[1] for item in items[:2 * n - 2]]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, int):
+            lengths[item] += 1
+        else:
+            stack.extend(item)
+    return dict([(symbols[k], lengths[k]) for k in range(n)])
+
+
+def code_bits(frequencies, lengths):
+    """Number of bits taken by symbols with counts frequencies coded with codeword lengths"""
+    return sum([frequencies[a] * lengths[a] for a in frequencies])
+
+
+def canonical_code(lengths):
+    """
+    Builds the canonical prefix code with the given codeword lengths.
+
+    Symbols are ordered by (length, symbol) and given consecutive codewords, so
+    the code is fully determined by the lengths and only those need storing.
+    """
+    code = {}
+    value, prev = 0, 0
+    for a in sorted(lengths, key=lambda a: (lengths[a], a)):
+        value <<= lengths[a] - prev
+        prev = lengths[a]
+        code[a] = [int(b) for b in format(value, '0%db' % prev)]
+        value += 1
+    return code
+
+
+def lengths2bytes(lengths):
+    """Packs a code length table for byte symbols as a 2 byte symbol count followed
+    by one (symbol, length) byte pair per symbol"""
+    y = bytearray(len(lengths).to_bytes(2, 'big'))
+    for a in sorted(lengths):
+        y.append(a)
+        y.append(lengths[a])
+    return bytes(y)
+
+
+def bytes2lengths(y, offset=0):
+    """Inverse of lengths2bytes, returns the length table and the offset just past it"""
+    n = int.from_bytes(y[offset:offset + 2], 'big')
+    offset += 2
+    lengths = dict([(y[offset + 2 * k], y[offset + 2 * k + 1]) for k in range(n)])
+    return lengths, offset + 2 * n
 
 
 def bits2bytes(x):
-    n = len(x)+3
-    r = (8 - n % 8) % 8
-    prefix = format(r, '03b')
-    x = ''.join(str(a) for a in x)
-    suffix = '0'*r
-    x = prefix + x + suffix
-    x = [x[k:k+8] for k in range(0,len(x),8)]
-    y = []
-    for a in x:
-        y.append(int(a,2))
-
-    return y
+    w = BitWriter()
+    w.extend(x)
+    return list(w.getvalue())
 
 
 def bytes2bits(y):
-    x = [format(a, '08b') for a in y]
-    r = int(x[0][0:3],2)
-    x = ''.join(x)
-    x = [int(a) for a in x]
-    for k in range(3):
-        x.pop(0)
-    for k in range(r):
-        x.pop()
-    return x
+    return list(BitReader(bytes(y)))
+
+
+def pack_code(c):
+    """Returns a dictionary mapping each symbol to its codeword packed as
+    an integer, together with the codeword length"""
+    return dict([(a, (int(''.join(str(b) for b in c[a]) or '0', 2), len(c[a]))) for a in c])
 
 
 def vl_encode(x, c):
-    y = []
-    for a in x:
-        y.extend(c[a])
-    return y
-
-
-def vl_decode(y, xt):
-    x = []
-    root = [k for k in range(len(xt)) if xt[k][0]==-1]
-    if len(root) != 1:
-        raise NameError('Tree with no or multiple roots!')
-    root = root[0]
-    leaves = [k for k in range(len(xt)) if len(xt[k][1]) == 0]
-
-    n = root
-    for k in y:
-        if len(xt[n][1]) < k:
-            raise NameError('Symbol exceeds alphabet size in tree node')
-        if xt[n][1][k] == -1:
-            raise NameError('Symbol not assigned in tree node')
-        n = xt[n][1][k]
-        if len(xt[n][1]) == 0: # it's a leaf!
-            x.append(xt[n][2])
-            n = root
-    return x
+    # every codeword is turned once into a string of '0' and '1' characters, then
+    # ENCODE_CHUNK symbols at a time are encoded by joining their strings, which
+    # the writer converts to an integer and packs in one go, so there is no
+    # interpreter work per bit and only a lookup per symbol
+    table = dict([(a, ''.join([str(b) for b in c[a]])) for a in c])
+    if all([isinstance(a, int) and 0 <= a < 256 for a in table]):
+        table = [table.get(a) for a in range(256)]  # byte symbols index a list, faster still
+    w = BitWriter()
+    for start in range(0, len(x), ENCODE_CHUNK):
+        w.write_bitstring(''.join(map(table.__getitem__, x[start:start + ENCODE_CHUNK])))
+    return w.getvalue()
+
+
+def vl_decode(y, tree):
+    """Decodes the bits y by walking down the code tree, a trees.Tree or an xtree"""
+    if not isinstance(tree, Tree):
+        tree = Tree.from_xtree(tree)
+    if not isinstance(y, BitReader):
+        y = BitReader(y)
+    return tree.decode(y)
+
+
+def make_decode_table(c, table_bits=10):
+    """
+    Builds lookup tables for decoding the prefix code c several bits at a time.
+
+    The primary table is indexed by the next table_bits bits of the stream. Each
+    entry holds every whole codeword that fits in those bits (so one lookup can
+    decode several short symbols), the number of bits they use and the length
+    of the first codeword. Codewords longer than table_bits are resolved with a
+    second-level table hanging off the entry of their first table_bits bits.
+
+    Returns:
+    --------
+    tuple (table_bits, maxlen, entries, bytesyms) to be passed to vl_decode_table
+    """
+    codes = pack_code(c)
+    maxlen = max([codes[a][1] for a in codes])
+    if min([codes[a][1] for a in codes]) == 0:
+        # such as the code shannon_fano gives a single symbol: vl_encode writes
+        # no bits for it, so there is nothing to decode (container.make_model gives it 1 bit)
+        raise NameError('A codeword is empty, so the stream cannot be decoded')
+    k = max(min(table_bits, maxlen), 1)
+    mask = (1 << k) - 1
+
+    # single symbol table for the short codewords, grouping the long ones by prefix
+    single = [None] * (1 << k)
+    long = {}
+    for a in codes:
+        v, length = codes[a]
+        if length <= k:
+            for i in range(v << (k - length), (v + 1) << (k - length)):
+                single[i] = (a, length)
+        else:
+            long.setdefault(v >> (length - k), []).append((a, v, length))
+
+    # when every symbol is a byte, decoded runs are stored as bytes and appended to a bytearray
+    bytesyms = all([isinstance(a, int) and 0 <= a < 256 for a in codes])
+
+    entries = [None] * (1 << k)
+    for i in range(1 << k):
+        if single[i] is None:
+            if i not in long:
+                continue  # not a prefix of any codeword (incomplete code)
+            sub_bits = max([length for a, v, length in long[i]]) - k
+            sub = [None] * (1 << sub_bits)
+            for a, v, length in long[i]:
+                rem = length - k
+                low = v & ((1 << rem) - 1)
+                for j in range(low << (sub_bits - rem), (low + 1) << (sub_bits - rem)):
+                    sub[j] = (a, length)
+            entries[i] = (None, sub_bits, sub)
+        else:
+            a, first = single[i]
+            syms, used = [a], first
+            # keep decoding from the leftover bits while a whole codeword fits
+            while used < k:
+                nxt = single[(i << used) & mask]
+                if nxt is None or nxt[1] > k - used:
+                    break
+                syms.append(nxt[0])
+                used += nxt[1]
+            entries[i] = (bytes(syms) if bytesyms else tuple(syms), used, first)
+
+    return k, maxlen, entries, bytesyms
+
+
+def vl_decode_table(y, table):
+    """Decodes the packed stream y with a table built by make_decode_table"""
+    k, maxlen, entries, bytesyms = table
+    mask = (1 << k) - 1
+    y = bytes(y)
+    if len(y) == 0:
+        raise NameError('Empty bit stream')
+
+    x = bytearray() if bytesyms else []
+    remaining = 8 * len(y) - (y[0] >> 5) - 3  # payload bits left to decode
+    acc, nacc, bytepos = y[0] & 0x1f, 5, 1
+
+    # fast path: at least one longest codeword of real bits ahead, so no lookup can run off the end
+    while remaining >= maxlen:
+        if nacc < maxlen:
+            acc = ((acc & ((1 << nacc) - 1)) << 64) | int.from_bytes(y[bytepos:bytepos + 8].ljust(8, b'\0'), 'big')
+            nacc += 64
+            bytepos += 8
+        syms, n, extra = entries[(acc >> (nacc - k)) & mask] or (None, 0, None)
+        if syms is None:
+            if extra is None:
+                raise NameError('Invalid codeword in stream')
+            entry = extra[(acc >> (nacc - k - n)) & ((1 << n) - 1)]
+            if entry is None:
+                raise NameError('Invalid codeword in stream')
+            x.append(entry[0])
+            n = entry[1]
+        else:
+            x += syms
+        nacc -= n
+        remaining -= n
+
+    # tail: one symbol at a time, checking each codeword ends within the stream
+    while remaining > 0:
+        if nacc < maxlen:
+            acc = ((acc & ((1 << nacc) - 1)) << 64) | int.from_bytes(y[bytepos:bytepos + 8].ljust(8, b'\0'), 'big')
+            nacc += 64
+            bytepos += 8
+        syms, n, extra = entries[(acc >> (nacc - k)) & mask] or (None, 0, None)
+        if syms is None:
+            if extra is None:
+                raise NameError('Invalid codeword in stream')
+            entry = extra[(acc >> (nacc - k - n)) & ((1 << n) - 1)]
+            if entry is None:
+                raise NameError('Invalid codeword in stream')
+            a, n = entry
+        else:
+            a, n = syms[0], extra
+        if n > remaining:
+            raise NameError('Truncated codeword at end of stream')
+        x.append(a)
+        nacc -= n
+        remaining -= n
 
+    return x